@@ -0,0 +1,388 @@
+"""
+    Manual benchmarks for the chat pipeline.
+    Run with `./run bench <name>`, e.g. `./run bench concurrency`.
+"""
+import asyncio
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Concurrency benchmark
+def bench_concurrency(concurrency:int = 32, llm_delay:float = 0.4, blocking_delay:float = 0.2):
+    """
+        Fires N concurrent /chat/ requests and exits non-zero when they take more than
+        twice one request. The llm is a slow async fake, while the query embedding, the
+        chroma searches and the cross-encoder are slow synchronous fakes behind the real
+        retrieval path, so any of them running on the event loop serialises the requests.
+        Hermetic: redis is fakeredis and the vector stores are in-memory chroma collections.
+    """
+    import os
+    import sys
+    # Set before dotenv runs, which does not override it, so no run is traced to langsmith
+    os.environ["LANGCHAIN_TRACING_V2"] = os.environ["LANGSMITH_TRACING"] = "false"
+    # The fakes sleep instead of using cpu, so the executor size must not be what limits them
+    os.environ.setdefault("CPU_EXECUTOR_WORKERS", str(int(concurrency) * 2))
+
+    import chromadb
+    import fakeredis
+    import httpx
+    from langchain_chroma import Chroma
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    import initial
+    import main
+    from core.cross_encoder import CrossEncoderReranker
+    from core.customer_auth import create_customer_token
+    from core.embedding_batcher import EmbeddingMicroBatcher
+    from core.embedding_cache import CachedEmbeddings
+
+    class SlowChatModel(BaseChatModel):
+        delay: float = llm_delay
+        reply: str = "ok"
+
+        @property
+        def _llm_type(self) -> str:
+            return "slow-fake"
+
+        def get_num_tokens(self, text:str) -> int:
+            # The default one loads a GPT-2 tokenizer from transformers
+            return initial.COUNT_TOKENS(text)
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            time.sleep(self.delay)
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            await asyncio.sleep(self.delay)
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+    class SlowEmbeddings(DeterministicFakeEmbedding):
+        def embed_documents(self, texts:List[str]) -> List[List[float]]:
+            time.sleep(blocking_delay)
+            return super().embed_documents(texts)
+
+        def embed_query(self, text:str) -> List[float]:
+            time.sleep(blocking_delay)
+            return super().embed_query(text)
+
+    class SlowCollection:
+        """Chroma collection whose reads block like a large on-disk one."""
+        def __init__(self, collection):
+            self.collection = collection
+
+        def __getattr__(self, name:str):
+            attribute = getattr(self.collection, name)
+            if name not in ("query", "get"):
+                return attribute
+            def slow(*args, **kwargs):
+                time.sleep(blocking_delay)
+                return attribute(*args, **kwargs)
+            return slow
+
+    class SlowCrossEncoder:
+        def predict(self, pairs, **kwargs):
+            time.sleep(blocking_delay)
+            return [1.0 / (index + 1) for index in range(len(pairs))]
+
+    fast_embeddings = DeterministicFakeEmbedding(size=384)
+    client = chromadb.EphemeralClient()
+    for division in list(initial.VECTOR_DB):
+        store = Chroma(client=client, collection_name=f"bench_{division}", embedding_function=fast_embeddings)
+        store.add_texts(
+            [f"Product Name: shoes model {index}, Product Price: {index}" for index in range(200)],
+            metadatas=[{"tags": "product_tag"} for _ in range(200)]
+        )
+        store._chroma_collection = SlowCollection(store._chroma_collection)
+        initial.VECTOR_DB[division] = lambda tenant, create=False, store=store: store
+
+    slow_embeddings = SlowEmbeddings(size=384)
+    initial.REDIS_CLIENT = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    initial.EMBEDDING_FUNCTION = CachedEmbeddings(
+        slow_embeddings,
+        batcher=EmbeddingMicroBatcher(
+            slow_embeddings,
+            run_blocking=initial.RUN_BLOCKING,
+            max_batch_size=initial.EMBEDDING_BATCH['max_batch_size'],
+            max_wait_ms=initial.EMBEDDING_BATCH['max_wait_ms']
+        ) if initial.EMBEDDING_BATCH['enabled'] else None
+    )
+    initial.HAS_TENANT = lambda tenant: True
+    initial.CUSTOMER_AUTH['secret'] = "bench"
+    initial.KEYWORD_INDEX['enabled'] = False  # persisted indexes belong to the real collections
+    initial.DIVISION_CLASSIFIER['enabled'] = False
+    initial.CROSS_ENCODER.update(enabled=True, time_budget_ms=60000, max_in_flight=concurrency)
+    CrossEncoderReranker._models[initial.CROSS_ENCODER['model']] = SlowCrossEncoder()
+    for model_name in list(initial.MODELS.keys()):
+        initial.MODELS[model_name] = SlowChatModel()
+
+    async def call(client:httpx.AsyncClient, index:int) -> None:
+        # Every other request is a logged in customer, their orders go through the refine stage
+        headers = {}
+        payload = {"message": f"show me some shoes {index}", "session_id": f"bench-{index}"}
+        if index % 2:
+            headers["Authorization"] = f"Bearer {create_customer_token(index, initial.COLLECTION_NAME)}"
+            payload["message"] = f"show me my orders for shoes {index}"
+        response = await client.post("/chat/", json=payload, headers=headers)
+        await response.aread()
+        response.raise_for_status()
+
+    async def measure() -> tuple[float, float]:
+        # both runs share one event loop, the redis client is bound to it
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            await asyncio.gather(call(client, -1), call(client, -2))  # warm up
+            timings = []
+            for count in (1, concurrency):
+                start = time.perf_counter()
+                await asyncio.gather(*(call(client, index) for index in range(count)))
+                timings.append(time.perf_counter() - start)
+        # Memory writes run after the responses, their failures would otherwise go unnoticed
+        await initial.BACKGROUND_TASKS.drain(initial.BACKGROUND_TASKS_DRAIN_TIMEOUT)
+        return timings[0], timings[1]
+
+    single, concurrent = asyncio.run(measure())
+    print(f"1 request          : {single:.2f}s")
+    print(f"{concurrency} concurrent requests: {concurrent:.2f}s ({concurrent / single:.2f}x of one)")
+    failed = initial.BACKGROUND_TASKS.stats()['failed']
+    if failed:
+        print(f"❌ {failed} background tasks failed")
+    if concurrent > single * 2:
+        print("❌ Requests are serialised, something is blocking the event loop!")
+    if failed or concurrent > single * 2:
+        sys.exit(1)
+    print("✅ Requests ran concurrently")
+
+
+# Intent scanner benchmark
+INTENT_MESSAGES = [
+    "hello",
+    "good morning",
+    "show me my last orders",
+    "what is in my cart",
+    "cancel my order",
+    "what types of products do you have",
+    "products in the shoes category",
+    "any blog posts by authors",
+    "nice to meet you",
+    "is there any sale today on running shoes and sandals",
+]
+
+def _legacy_intent(message:str):
+    """Pattern work the old Rag did per request: greeting, user scoping and two tag lookups."""
+    import re
+    import initial
+
+    greeting_pattern = initial.GREETING_PATTERNS['greeting_pattern']
+    strict_gretting_pattern = initial.GREETING_PATTERNS['strict_gretting_pattern']
+    greeting = (
+        re.search(greeting_pattern, message) or re.search(strict_gretting_pattern, message)
+        or 'nice to meet you' in message or 'how are you' in message
+    )
+
+    is_user_scoped = bool(
+        re.search(initial.USER_PATTERN['self_reffering_pattern'], message, re.IGNORECASE)
+        and re.search(initial.USER_PATTERN['entity_pattern'], message, re.IGNORECASE)
+        and not re.search(initial.USER_PATTERN['exclued_pattern'], message, re.IGNORECASE)
+    )
+
+    patterns = initial.FILTER_TAG_PATTERNS
+    for _ in range(2):
+        tag = None
+        if patterns['helper_category_pattern'].search(message) and not patterns['excluding_category_pattern'].search(message):
+            if patterns['product_pattern'].search(message):
+                tag = 'product_category_tag'
+            elif patterns['post_pattern'].search(message):
+                tag = 'post_category_tag'
+        if tag is None:
+            for name, candidate in (('cart_pattern', 'cart_tag'), ('product_pattern', 'product_tag'),
+                                    ('order_pattern', 'order_tag'), ('post_pattern', 'post_tag')):
+                if patterns[name].search(message):
+                    tag = candidate
+                    break
+    return bool(greeting), is_user_scoped, tag
+
+def bench_intent(iterations:int = 20000):
+    """Compares the single pass intent scanner with the old per request pattern calls."""
+    import timeit
+    import initial
+
+    for message in INTENT_MESSAGES:
+        intent = initial.INTENT_SCANNER.scan(message)
+        legacy = _legacy_intent(message)
+        if (intent.greeting is not None, intent.is_user_scoped, intent.filter_tag) != legacy:
+            print(f"⚠️ Mismatch for '{message}': scanner={intent} legacy={legacy}")
+
+    per_message = iterations * len(INTENT_MESSAGES)
+    legacy_time = timeit.timeit(lambda: [_legacy_intent(message) for message in INTENT_MESSAGES], number=iterations)
+    scanner_time = timeit.timeit(lambda: [initial.INTENT_SCANNER.scan(message) for message in INTENT_MESSAGES], number=iterations)
+    print(f"legacy  : {legacy_time / per_message * 1e6:.2f}µs per request")
+    print(f"scanner : {scanner_time / per_message * 1e6:.2f}µs per request")
+
+
+# MMR benchmark
+def bench_mmr(k:int = 10, lambda_mult:float = 0.8, dimensions:int = 768):
+    """Compares `mmr_select` with LangChain's MMR loop at fetch_k of 200, 1000 and 5000."""
+    import timeit
+    import numpy as np
+    from langchain_chroma.vectorstores import maximal_marginal_relevance
+    from core.mmr import mmr_select, mmr_select_batch
+
+    rng = np.random.default_rng(42)
+    for fetch_k in (200, 1000, 5000):
+        # Clustered vectors behave more like real embeddings than pure noise
+        centers = rng.normal(size=(20, dimensions)).astype(np.float32)
+        candidates = (centers[rng.integers(0, 20, fetch_k)] + 0.7 * rng.normal(size=(fetch_k, dimensions))).astype(np.float32)
+        queries = (centers[:8] + 0.5 * rng.normal(size=(8, dimensions))).astype(np.float32)
+
+        same = all(
+            maximal_marginal_relevance(query, candidates, lambda_mult=lambda_mult, k=k)
+            == mmr_select(query, candidates, k=k, lambda_mult=lambda_mult)
+            for query in queries
+        )
+        same_batch = mmr_select_batch(queries, candidates, k=k, lambda_mult=lambda_mult) == [
+            mmr_select(query, candidates, k=k, lambda_mult=lambda_mult) for query in queries
+        ]
+
+        repeat = 3 if fetch_k > 1000 else 10
+        langchain_time = timeit.timeit(lambda: maximal_marginal_relevance(queries[0], candidates, lambda_mult=lambda_mult, k=k), number=repeat) / repeat
+        numpy_time = timeit.timeit(lambda: mmr_select(queries[0], candidates, k=k, lambda_mult=lambda_mult), number=repeat) / repeat
+        batch_time = timeit.timeit(lambda: mmr_select_batch(queries, candidates, k=k, lambda_mult=lambda_mult), number=repeat) / repeat / len(queries)
+
+        print(
+            f"fetch_k={fetch_k:<5} same={same and same_batch} "
+            f"langchain={langchain_time * 1000:.2f}ms mmr_select={numpy_time * 1000:.2f}ms "
+            f"batch={batch_time * 1000:.2f}ms/query ({langchain_time / numpy_time:.1f}x)"
+        )
+
+
+# Embedding backend benchmark
+def bench_embeddings(samples:int = 256, queries:int = 50):
+    """
+        Compares the torch and the onnx int8 embedding backends on the same texts:
+        batch throughput, single query latency, and how closely the vectors agree.
+    """
+    import numpy as np
+    import initial
+
+    products = ["running shoes", "wireless headphones", "leather wallet", "garden hose", "coffee grinder", "yoga mat"]
+    questions = [
+        "Do you have {} in stock?", "What is the price of the {}?", "Show me {} under 50 dollars",
+        "Which {} would you recommend for a beginner?", "How long does shipping take for {}?",
+    ]
+    texts = [questions[index % len(questions)].format(products[index // len(questions) % len(products)]) + f" #{index}" for index in range(samples)]
+
+    vectors = {}
+    for backend in ('torch', 'onnx'):
+        embeddings = initial.initialise_embeddings(backend)
+        embeddings.show_progress = False
+        embeddings.embed_documents(texts[:8])  # warm up
+
+        started = time.perf_counter()
+        vectors[backend] = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        throughput = len(texts) / (time.perf_counter() - started)
+
+        latencies = []
+        for text in texts[:queries]:
+            started = time.perf_counter()
+            embeddings.embed_query(text)
+            latencies.append(time.perf_counter() - started)
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        print(f"{backend:<5}: {throughput:.1f} texts/s, query p50={p50:.1f}ms p95={p95:.1f}ms")
+
+    agreement = (vectors['torch'] * vectors['onnx']).sum(axis=1)
+    # Same nearest neighbours is what retrieval cares about
+    top = lambda matrix: np.argsort(-(matrix[:queries] @ matrix.T), axis=1)[:, 1:6]
+    overlap = np.mean([len(set(a) & set(b)) / 5 for a, b in zip(top(vectors['torch']), top(vectors['onnx']))])
+    print(f"cosine agreement: mean={agreement.mean():.4f} min={agreement.min():.4f}, top-5 neighbour overlap={overlap:.2%}")
+
+
+# Query embedding micro-batching benchmark
+def bench_embedding_batching(concurrency:int = 32, rounds:int = 5):
+    """Embeds `concurrency` simultaneous queries one call each, then through the micro-batcher."""
+    import initial
+    from core.embedding_batcher import EmbeddingMicroBatcher
+
+    embeddings = initial.BASE_EMBEDDING_FUNCTION
+    embeddings.show_progress = False
+    batcher = EmbeddingMicroBatcher(
+        embeddings,
+        run_blocking=initial.RUN_BLOCKING,
+        max_batch_size=initial.EMBEDDING_BATCH['max_batch_size'],
+        max_wait_ms=initial.EMBEDDING_BATCH['max_wait_ms']
+    )
+    queries = [f"do you have size {index} shoes in blue" for index in range(concurrency)]
+
+    async def measure(embed) -> float:
+        await asyncio.gather(*[embed(query) for query in queries[:4]])  # warm up
+        started = time.perf_counter()
+        for _ in range(int(rounds)):
+            await asyncio.gather(*[embed(query) for query in queries])
+        return concurrency * rounds / (time.perf_counter() - started)
+
+    single = asyncio.run(measure(lambda query: initial.RUN_BLOCKING(embeddings.embed_query, query)))
+    batched = asyncio.run(measure(batcher.aembed_query))
+    print(f"one call per query: {single:.1f} queries/s")
+    print(f"micro-batched     : {batched:.1f} queries/s ({batched / single:.1f}x), mean batch size {batcher.stats()['mean_batch_size']}")
+
+
+# Import time report
+def report_import_times(limit:int = 15):
+    """
+        Imports `initial` in a fresh `python -X importtime` process, sums the self time
+        of every imported module by top level package, then creates each lazy resource once
+        and times it, so a slow startup can be pinned on a package or a resource.
+    """
+    import subprocess
+    import sys
+    from collections import defaultdict
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import initial"],
+        capture_output=True, text=True
+    )
+    packages:Dict[str, int] = defaultdict(int)
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, _, name = line.removeprefix("import time:").split("|", 2)
+        if not own.strip().isdigit():
+            continue  # header line
+        # Self times of all submodules add up to what the package costs, nested or not
+        packages[name.strip().split(".")[0]] += int(own)
+
+    if process.returncode != 0:
+        print(process.stderr.strip().splitlines()[-1])
+    print(f"{'import (ms)':>16} | package")
+    for package, microseconds in sorted(packages.items(), key=lambda item: -item[1])[:int(limit)]:
+        print(f"{microseconds / 1000:>16.1f} | {package}")
+    print(f"{sum(packages.values()) / 1000:>16.1f} | total")
+
+    import initial
+
+    print(f"\n{'init (ms)':>16} | resource")
+    for name in [*initial._LAZY.names, *(f"MODELS.{model}" for model in initial.MODELS)]:
+        try:
+            asyncio.run(initial.WARM_UP(name))
+        except Exception as exc:
+            print(f"{'failed':>16} | {name}: {exc}")
+            continue
+        print(f"{initial.RESOURCE_INIT_TIMES.get(name, 0) * 1000:>16.1f} | {name}")
+
+
+BENCHMARKS: Dict[str, Callable[..., Any]] = {
+    "concurrency": bench_concurrency,
+    "intent": bench_intent,
+    "mmr": bench_mmr,
+    "embeddings": bench_embeddings,
+    "batching": bench_embedding_batching,
+    "importtime": report_import_times,
+}
+
+
+def run_benchmark(name:Optional[str], args:Optional[List[str]] = None):
+    if name not in BENCHMARKS:
+        print(f"Unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}")
+        return
+    BENCHMARKS[name](*[float(arg) if '.' in arg else int(arg) for arg in (args or [])])
@@ -3,22 +3,28 @@ import json
 import re
 import traceback
 import pandas as pd
-from typing import List
+from typing import List, Optional
 from sqlalchemy import create_engine, inspect
 from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from core.api_loader import ApiLoader
+from core.division_classifier import DivisionClassifier
 from core.extractor import ContentExtractor
+from core.faq_index import FaqIndex
+from core.keyword_index import KeywordIndex
+from core.semantic_cache import SemanticCache
+from core.vector_registry import UnknownCollection
 from PyPDF2 import PdfReader
 import initial
 
 
 class ChromaDBPopulator:
     
-    def __init__(self):
-        """Initialize ChromaDB Populator."""
+    def __init__(self, tenant:Optional[str] = None):
+        """Initialize ChromaDB Populator for one shop, the default collection when not given."""
         
         self.config = initial.GET_CONFIGS('database')
+        self.tenant = tenant or initial.COLLECTION_NAME
    
     async def populate_chroma_db(self):
         """
@@ -49,14 +55,37 @@ class ChromaDBPopulator:
             traceback.print_exc()
             print(f"❌ Chroma Populator error: {e}")
 
+        await self.__after_ingestion()
         print("🚀 ChromaDB population complete!")
         
+    async def __after_ingestion(self):
+        """Refresh everything derived from the collections once ingestion is done."""
+        
+        # New version makes every cached answer of the old data unreachable
+        version = await initial.BUMP_COLLECTION_VERSION(self.tenant)
+        await SemanticCache.invalidate(self.tenant)
+        print(f"🔄 Collection '{self.tenant}' bumped to version {version}")
+
+        # Recompute the local division centroids from the new vectors
+        classifier = DivisionClassifier(self.tenant)
+        await initial.RUN_BLOCKING(classifier.fit)
+        classifier.save()
+
+        # Rebuild the BM25 postings of every division
+        for division in initial.VECTOR_DB:
+            try:
+                await initial.RUN_BLOCKING(KeywordIndex(self.tenant, division).build)
+            except UnknownCollection:
+                print(f"⚠️ No '{division}' collection for '{self.tenant}', skipping keyword index")
+
+        await initial.RUN_BLOCKING(FaqIndex.build, self.tenant)
+
 
     # Document loader
     async def load_documents_data(self):
         """Load data from '.json' file and store in ChromaDB."""
         
-        vectorstore = initial.VECTOR_DB['document'](initial.COLLECTION_NAME)
+        vectorstore = initial.VECTOR_DB['document'](self.tenant, create=True)
         for document in self.config['documents']:
             file_extension = document.split('.')[-1].lower()
             
@@ -156,7 +185,7 @@ class ChromaDBPopulator:
         # self.inspector = inspect(SQLITE_DATABASE_ENGINE)
         
         table_names = self.inspector.get_table_names()
-        vectorstore = initial.VECTOR_DB['database'](initial.COLLECTION_NAME)
+        vectorstore = initial.VECTOR_DB['database'](self.tenant, create=True)
 
         for table in self.config.get('relational_tables'):
             if table not in table_names:
@@ -194,7 +223,7 @@ class ChromaDBPopulator:
                         "division": initial.DIVISIONS["db"], 
                         "source": table, 
                         "tags":tag
-                    }
+                    } | self.__id_metadata(row)
                 )
                 for _, row in df.iterrows()
             ]
@@ -284,7 +313,7 @@ class ChromaDBPopulator:
                         "division": initial.DIVISIONS["db"], 
                         "source": table, 
                         "tags":tag
-                    }
+                    } | self.__id_metadata(row)
             )
             for _, row in merged_df.iterrows()
         ]
@@ -323,7 +352,7 @@ class ChromaDBPopulator:
     # Website content loader 
     async def load_websites_content_data(self):     
         try:
-            vectorstore = initial.VECTOR_DB['website'](initial.COLLECTION_NAME)
+            vectorstore = initial.VECTOR_DB['website'](self.tenant, create=True)
             web_url:str = self.config['website_url']
             
             extractor = ContentExtractor()
@@ -358,7 +387,7 @@ class ChromaDBPopulator:
     # Apis data loader
     async def load_apis_data(self):
         base_url = 'https://sident.24livehost.com/'
-        vectorstore = initial.VECTOR_DB['database'](initial.COLLECTION_NAME)
+        vectorstore = initial.VECTOR_DB['database'](self.tenant, create=True)
 
         loader = ApiLoader('wordpress' ,base_url, vectorstore)
         # await loader.wp_data_loader(['post_category', 'posts', 'product_category', 'products', 'orders'])
@@ -390,6 +419,21 @@ class ChromaDBPopulator:
             print(f"Error while adding documents - {str(e)}")
             return None
         
+    def __id_metadata(self, row) -> dict:
+        # Typed customer/order ids, so personal queries can pre-filter on the customer
+        metadata = {}
+        for column, value in row.items():
+            if column == "text" or pd.isna(value):
+                continue
+            for key, pattern in initial.ID_METADATA_PATTERNS.items():
+                if key in metadata or not pattern.search(column):
+                    continue
+                try:
+                    metadata[key] = int(value)
+                except (TypeError, ValueError):
+                    pass
+        return metadata
+
     def __filter_tag(self, tablename:str):
         # Here are detecting the limited filters, but in future we can add more here
         # e.g - shippers, sellers or any table names used by the companies
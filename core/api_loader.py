@@ -53,7 +53,7 @@ class ApiLoader:
         },
         'orders':{
             'per_page': 100,
-            "_fields":"status,date_created,discount_total,shipping_total,total,customer_id,billing,line_items",
+            "_fields":"id,status,date_created,discount_total,shipping_total,total,customer_id,billing,line_items",
             "status":"pending,processing,on-hold,completed,cancelled,refunded,failed"
         },
     }
@@ -154,7 +154,8 @@ class ApiLoader:
             elif endpoint in ['wp_users', 'wo_users']:
                 updated_endpoint = 'users'
                 
-            res = wcapi.get(updated_endpoint, params=formatted_params)
+            # requests based client, run it in a thread so the event loop stays free
+            res = await asyncio.to_thread(wcapi.get, updated_endpoint, params=formatted_params)
             if res.status_code == 200:
                 return res
             else:
@@ -256,6 +257,7 @@ class ApiLoader:
             ]
             
             formatted_orders.append({
+                "order_id": order.get("id", 0),
                 "status": "success" if order.get("status") == "completed" else "pending",
                 "currency": order.get("currency", "INR"),
                 "date_created": order.get("date_created", ""),
@@ -371,14 +373,21 @@ class ApiLoader:
         documents = []
         for item in data:
             flatten_data = self.__flatten_dict(item, endpoint) 
+            metadata = {
+                "devision": initial.DIVISIONS["db"], 
+                "source": self.platform, 
+                "tags": f"{endpoint.rstrip('s')}_tag"
+            }
+
+            # Typed ids, so personal queries can pre-filter on the customer
+            for key in ("customer_id", "order_id"):
+                if isinstance(item, dict) and str(item.get(key, "")).isdigit():
+                    metadata[key] = int(item[key])
+
             documents.append(
                 Document(
                     page_content=", ".join(f"{key}:{value}" for key, value in flatten_data.items()),
-                    metadata={
-                        "devision": initial.DIVISIONS["db"], 
-                        "source": self.platform, 
-                        "tags": f"{endpoint.rstrip('s')}_tag"
-                    }
+                    metadata=metadata
                 )
             )
         return documents
@@ -0,0 +1,157 @@
+import asyncio
+import traceback
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Union
+
+
+@dataclass(eq=False)
+class _Job:
+    name: str
+    key: Optional[str]
+    droppable: bool
+    factory: Callable[[], Awaitable[Any]]
+
+
+class BackgroundTaskRunner:
+
+    def __init__(self, max_concurrency:int, max_queue:int):
+        """
+            Supervised post-response work. Every task is referenced until it ends,
+            at most `max_concurrency` run at once, and the waiting queue is bounded:
+            a keyed job replaces the waiting job with the same key, and when the
+            queue is full the oldest droppable job gives way. Delayed jobs sit on a
+            loop timer and only enter the queue once they are due.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.jobs:Dict[asyncio.Task, _Job] = {}
+        self.waiting:Dict[asyncio.Task, _Job] = {}
+        self.running:Set[asyncio.Task] = set()
+        self.delayed:Dict[_Job, asyncio.TimerHandle] = {}
+        self.keyed:Dict[str, Union[asyncio.Task, _Job]] = {}
+        self.accepting = True
+        self.counters:Dict[str, int] = {
+            'submitted': 0, 'completed': 0, 'failed': 0, 'dropped': 0, 'merged': 0
+        }
+
+    @property
+    def depth(self) -> int:
+        """Runnable jobs waiting for a slot, jobs that are not due yet do not count."""
+        return len(self.waiting)
+
+    def submit(
+        self,
+        factory:Callable[[], Awaitable[Any]],
+        name:str = "task",
+        key:Optional[str] = None,
+        droppable:bool = True,
+        delay:float = 0.0
+    ) -> bool:
+        """
+            Schedules `factory()` to run after `delay` seconds.
+            Returns False when the job was dropped instead.
+        """
+        if not self.accepting:
+            self.counters['dropped'] += 1
+            return False
+
+        # The newer job supersedes the one still waiting under the same key
+        if key and (previous := self.keyed.get(key)) is not None:
+            if previous in self.delayed:
+                self.delayed.pop(previous).cancel()
+                self.counters['merged'] += 1
+            elif previous in self.waiting:
+                previous.cancel()
+                self.waiting.pop(previous)
+                self.counters['merged'] += 1
+
+        job = _Job(name=name, key=key, droppable=droppable, factory=factory)
+        if delay > 0:
+            self.delayed[job] = asyncio.get_running_loop().call_later(delay, self.__due, job)
+            if key:
+                self.keyed[key] = job
+            self.counters['submitted'] += 1
+            return True
+
+        if not self.__enqueue(job):
+            return False
+        self.counters['submitted'] += 1
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'depth': self.depth,
+            'running': len(self.running),
+            'delayed': len(self.delayed),
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+        } | self.counters
+
+    async def drain(self, timeout:float):
+        """Stops accepting work, cancels delayed jobs and waits for the rest up to `timeout`."""
+        self.accepting = False
+        for job, timer in list(self.delayed.items()):
+            timer.cancel()
+            self.__release_key(job, job)
+        self.delayed.clear()
+
+        pending = set(self.waiting) | self.running
+        if not pending:
+            return
+        print(f"⏳ Draining {len(pending)} background tasks")
+        _, still_running = await asyncio.wait(pending, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            print(f"⚠️ Cancelled {len(still_running)} background tasks after {timeout}s")
+
+    def __due(self, job:_Job):
+        self.delayed.pop(job, None)
+        self.__release_key(job, job)
+        if self.accepting:
+            self.__enqueue(job)
+
+    def __enqueue(self, job:_Job) -> bool:
+        if len(self.waiting) >= self.max_queue:
+            victim = next((task for task, waiting in self.waiting.items() if waiting.droppable), None)
+            if victim is None and job.droppable:
+                print(f"⚠️ Background queue full, dropping '{job.name}'")
+                self.counters['dropped'] += 1
+                return False
+            if victim is not None:
+                print(f"⚠️ Background queue full, dropping '{self.waiting[victim].name}'")
+                victim.cancel()
+                self.waiting.pop(victim)
+                self.counters['dropped'] += 1
+
+        task = asyncio.create_task(self.__run(job))
+        self.jobs[task] = self.waiting[task] = job
+        if job.key:
+            self.keyed[job.key] = task
+        task.add_done_callback(self.__forget)
+        return True
+
+    async def __run(self, job:_Job):
+        task = asyncio.current_task()
+        async with self.semaphore:
+            self.waiting.pop(task, None)
+            self.running.add(task)
+            try:
+                await job.factory()
+                self.counters['completed'] += 1
+            except Exception:
+                self.counters['failed'] += 1
+                print(f"❌ Background task '{job.name}' failed")
+                traceback.print_exc()
+
+    def __forget(self, task:asyncio.Task):
+        job = self.jobs.pop(task)
+        self.waiting.pop(task, None)
+        self.running.discard(task)
+        self.__release_key(job, task)
+
+    def __release_key(self, job:_Job, holder:Union[asyncio.Task, _Job]):
+        if job.key and self.keyed.get(job.key) is holder:
+            del self.keyed[job.key]
@@ -0,0 +1,110 @@
+import hashlib
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Set, Tuple
+from langchain_core.documents import Document
+import initial
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+@dataclass(frozen=True)
+class PackStats:
+    """Token accounting of one packing run."""
+    documents_in: int
+    documents_out: int
+    duplicates: int
+    tokens_in: int
+    tokens_out: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_in - self.tokens_out
+
+
+class ContextPacker:
+
+    def __init__(self, division:str, count_tokens:Callable[[str], int]):
+        """
+            Shrinks the retrieved documents before they are stuffed into the prompt.
+            Duplicates and chunk overlaps are dropped first, then the documents are
+            taken in retrieval order until the division's token budget is full.
+        """
+        self.config = initial.CONTEXT_PACKER
+        self.budget:int = self.config['budgets'].get(division, self.config['default_budget'])
+        self.count_tokens = count_tokens
+
+    def pack(self, documents:List[Document]) -> Tuple[List[Document], PackStats]:
+        tokens_in = sum(self.count_tokens(doc.page_content) for doc in documents)
+        unique_docs = self.__deduplicate(documents)
+
+        packed:List[Document] = []
+        used = 0
+        for doc in unique_docs:
+            tokens = self.count_tokens(doc.page_content)
+            # Skip what does not fit, a shorter lower ranked document may still do
+            if used + tokens > self.budget:
+                continue
+            packed.append(doc)
+            used += tokens
+
+        # Never send an empty context when the best document alone is over budget
+        if not packed and unique_docs:
+            packed, used = unique_docs[:1], self.count_tokens(unique_docs[0].page_content)
+
+        return packed, PackStats(
+            documents_in=len(documents),
+            documents_out=len(packed),
+            duplicates=len(documents) - len(unique_docs),
+            tokens_in=tokens_in,
+            tokens_out=used
+        )
+
+    def __deduplicate(self, documents:List[Document]) -> List[Document]:
+        kept:List[Document] = []
+        hashes:Set[str] = set()
+        shingles:List[Set[Tuple[str, ...]]] = []
+        texts:List[str] = []
+
+        for doc in documents:
+            text = " ".join(doc.page_content.split())
+            digest = hashlib.sha1(text.lower().encode()).hexdigest()
+            if digest in hashes:
+                continue
+
+            doc_shingles = self.__shingles(text)
+            if any(self.__jaccard(doc_shingles, other) >= self.config['near_duplicate_threshold'] for other in shingles):
+                continue
+
+            # Splitter overlaps repeat the tail of a kept chunk, only the new part is sent
+            trimmed = self.__trim_overlap(text, texts)
+            if trimmed != text:
+                doc = Document(id=doc.id, page_content=trimmed, metadata=doc.metadata)
+
+            hashes.add(digest)
+            shingles.append(doc_shingles)
+            texts.append(text)
+            kept.append(doc)
+        return kept
+
+    def __shingles(self, text:str) -> Set[Tuple[str, ...]]:
+        words = WORD_PATTERN.findall(text.lower())
+        size = self.config['shingle_size']
+        if len(words) < size:
+            return {tuple(words)}
+        return {tuple(words[index:index + size]) for index in range(len(words) - size + 1)}
+
+    def __jaccard(self, first:Set, second:Set) -> float:
+        if not first or not second:
+            return 0.0
+        return len(first & second) / len(first | second)
+
+    def __trim_overlap(self, text:str, kept_texts:List[str]) -> str:
+        window, minimum = self.config['overlap_window'], self.config['min_overlap']
+        best = 0
+        for kept_text in kept_texts:
+            for size in range(min(window, len(kept_text), len(text) - 1), max(best, minimum - 1), -1):
+                if kept_text.endswith(text[:size]):
+                    best = size
+                    break
+        return text[best:].lstrip() if best else text
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Set
+from langchain_core.documents import Document
+import initial
+
+
+class CrossEncoderReranker:
+    """Optional second stage that re-scores (query, document) pairs with a small CPU cross-encoder."""
+
+    _models:Dict[str, Any] = {}
+    _lock = threading.Lock()
+    # Scoring runs still busy on the executor, a timed out one keeps its thread until it ends
+    _in_flight:Set[asyncio.Future] = set()
+
+    def __init__(self):
+        self.config = initial.CROSS_ENCODER
+
+    @classmethod
+    def warm_up(cls):
+        """Loads the model at startup, so no request pays for it inside the time budget."""
+        if not initial.CROSS_ENCODER['enabled']:
+            return
+        try:
+            cls.__load_model(initial.CROSS_ENCODER['model'])
+        except Exception as e:
+            print(f"Cross-encoder unavailable, keeping vector order - {e}")
+
+    async def rerank(self, query:str, documents:List[Document]) -> List[Document]:
+        """
+            Scores every candidate in one batch and keeps the best `top_k`.
+            Falls back to the incoming vector order when the model is not loaded, when
+            earlier runs still occupy the executor, or when the time budget runs out.
+        """
+        top_k = self.config['top_k']
+        if not self.config['enabled'] or len(documents) <= 1:
+            return documents
+
+        model = self._models.get(self.config['model'])
+        if model is None:
+            print("⚠️ Cross-encoder model not loaded, keeping vector order")
+            return documents[:top_k]
+        # An overrunning run cannot be stopped, piling more on top would only starve the executor
+        if len(self._in_flight) >= self.config['max_in_flight']:
+            print("⚠️ Cross-encoder busy, keeping vector order")
+            return documents[:top_k]
+
+        started = time.perf_counter()
+        future = asyncio.ensure_future(initial.RUN_BLOCKING(self.__score, model, query, documents))
+        self._in_flight.add(future)
+        future.add_done_callback(self.__finished)
+
+        done, _ = await asyncio.wait({future}, timeout=self.config['time_budget_ms'] / 1000)
+        if not done:
+            print(f"⚠️ Cross-encoder exceeded {self.config['time_budget_ms']}ms, keeping vector order")
+            return documents[:top_k]
+        try:
+            scores = future.result()
+        except Exception as e:
+            print(f"Cross-encoder failed, keeping vector order - {e}")
+            return documents[:top_k]
+
+        ranked = sorted(range(len(documents)), key=lambda index: scores[index], reverse=True)
+        print(f"CROSS ENCODER........ {len(documents)} pairs in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return [documents[index] for index in ranked[:top_k]]
+
+    def __score(self, model, query:str, documents:List[Document]) -> List[float]:
+        pairs = [(query, doc.page_content) for doc in documents]
+        scores = model.predict(
+            pairs,
+            batch_size=max(len(pairs), self.config['batch_size']),
+            show_progress_bar=False
+        )
+        return [float(score) for score in scores]
+
+    @classmethod
+    def __finished(cls, future:asyncio.Future):
+        cls._in_flight.discard(future)
+        # Retrieves the error of a run nobody waited for, so it is not reported as unhandled
+        if not future.cancelled():
+            future.exception()
+
+    @classmethod
+    def __load_model(cls, model_name:str):
+        if model_name not in cls._models:
+            with cls._lock:
+                if model_name not in cls._models:
+                    from sentence_transformers import CrossEncoder
+                    cls._models[model_name] = CrossEncoder(
+                        model_name,
+                        max_length=initial.CROSS_ENCODER['max_length'],
+                        device="cpu"
+                    )
+        return cls._models[model_name]
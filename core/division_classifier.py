@@ -0,0 +1,81 @@
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from core.vector_registry import UnknownCollection
+from core.vectors import normalize, normalize_rows
+import initial
+
+
+class DivisionClassifier:
+    """Routes a query embedding to the closest collection centroid."""
+
+    _loaded:Dict[str, Tuple[float, "DivisionClassifier"]] = {}
+
+    def __init__(self, collection_name:str, centroids:Optional[Dict[str, np.ndarray]] = None):
+        self.collection_name = collection_name
+        self.centroids:Dict[str, np.ndarray] = centroids or {}
+
+    @property
+    def path(self) -> str:
+        return os.path.join(initial.DIVISION_CLASSIFIER['directory'], f"{self.collection_name}.npz")
+
+    def fit(self) -> "DivisionClassifier":
+        """Computes one normalised centroid per division from the stored chroma vectors."""
+        centroids = {}
+        for division in initial.VECTOR_DB:
+            try:
+                vectorstore = initial.VECTOR_DB[division](self.collection_name)
+            except UnknownCollection:
+                print(f"⚠️ No '{division}' collection for '{self.collection_name}', skipping centroid")
+                continue
+            embeddings = vectorstore._collection.get(include=['embeddings']).get('embeddings')
+            if embeddings is None or len(embeddings) == 0:
+                print(f"⚠️ No vectors in '{division}' for '{self.collection_name}', skipping centroid")
+                continue
+
+            matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+            centroids[division] = normalize_rows(matrix.mean(axis=0, keepdims=True))[0]
+
+        self.centroids = centroids
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.savez(self.path, **self.centroids)
+        self._loaded.pop(self.collection_name, None)
+        print(f"✅ Saved division centroids for '{self.collection_name}': {list(self.centroids)}")
+
+    @classmethod
+    def load(cls, collection_name:str) -> Optional["DivisionClassifier"]:
+        """Loads the persisted centroids, reloading when an ingestion run rewrote them."""
+        classifier = cls(collection_name)
+        if not os.path.exists(classifier.path):
+            return None
+
+        modified = os.path.getmtime(classifier.path)
+        cached = cls._loaded.get(collection_name)
+        if cached and cached[0] == modified:
+            return cached[1]
+
+        with np.load(classifier.path) as data:
+            classifier.centroids = {division: data[division] for division in data.files}
+        cls._loaded[collection_name] = (modified, classifier)
+        return classifier
+
+    def classify(self, embedding:List[float]) -> Tuple[Optional[str], float]:
+        """
+            Returns the closest division and its margin over the runner up.
+            The division is None when the margin is too small to trust.
+        """
+        if len(self.centroids) < 2:
+            return None, 0.0
+
+        divisions = list(self.centroids)
+        query = normalize(embedding)
+        scores = np.vstack([self.centroids[division] for division in divisions]) @ query
+
+        order = np.argsort(scores)[::-1]
+        margin = float(scores[order[0]] - scores[order[1]])
+        if margin < initial.DIVISION_CLASSIFIER['min_margin']:
+            return None, margin
+        return divisions[order[0]], margin
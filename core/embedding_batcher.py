@@ -0,0 +1,82 @@
+import asyncio
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingMicroBatcher:
+
+    def __init__(
+        self,
+        embeddings:Embeddings,
+        run_blocking:Callable[..., Awaitable[Any]],
+        max_batch_size:int = 8,
+        max_wait_ms:float = 5.0
+    ):
+        """
+            Collects concurrent query embeddings for up to `max_wait_ms` or `max_batch_size`
+            queries, whichever comes first, and embeds them with one `embed_documents` call
+            on the executor. Every caller gets back its own vector.
+        """
+        self.embeddings = embeddings
+        self.run_blocking = run_blocking
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self.pending:List[Tuple[str, asyncio.Future]] = []
+        self.timer:Optional[asyncio.TimerHandle] = None
+        self.batches:Set[asyncio.Task] = set()
+        self.batch_sizes:Counter = Counter()
+
+    async def aembed_query(self, text:str) -> List[float]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, future))
+
+        if len(self.pending) >= self.max_batch_size:
+            self.__flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.__flush)
+        return await future
+
+    def stats(self) -> Dict[str, Any]:
+        """How many queries each embedding call carried."""
+        batches = sum(self.batch_sizes.values())
+        queries = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "batches": batches,
+            "queries": queries,
+            "mean_batch_size": round(queries / batches, 2) if batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "pending": len(self.pending),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+    def __flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        self.batch_sizes[len(batch)] += 1
+        task = asyncio.create_task(self.__embed(batch))
+        self.batches.add(task)
+        task.add_done_callback(self.batches.discard)
+
+    async def __embed(self, batch:List[Tuple[str, asyncio.Future]]):
+        # The same question asked at the same moment is embedded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = dict(zip(texts, await self.run_blocking(self.embeddings.embed_documents, texts)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for text, future in batch:
+            # A caller that went away (cancelled request) leaves a finished future behind
+            if not future.done():
+                future.set_result(vectors[text])
@@ -0,0 +1,145 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from langchain_core.embeddings import Embeddings
+from core.vectors import decode_vector, encode_vector
+
+
+class CachedEmbeddings(Embeddings):
+
+    def __init__(
+        self,
+        embeddings:Embeddings,
+        max_size:int = 2048,
+        redis_client = None,
+        redis_ttl:int = 86400,
+        namespace:str = "embedding_cache",
+        batcher = None
+    ):
+        """
+            Bounded LRU cache around an embedding model's `embed_query`.
+            A sync redis client can be passed to share vectors across workers,
+            and an `EmbeddingMicroBatcher` to embed the misses of `aembed_query` together.
+        """
+        self.embeddings = embeddings
+        self.batcher = batcher
+        self.max_size = max_size
+        self.redis_client = redis_client
+        self.redis_ttl = redis_ttl
+        self.namespace = namespace
+
+        self._cache:OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        # Documents are embedded once at ingestion, no need to cache them
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text:str) -> List[float]:
+        normalized = self.normalize(text)
+        with self._lock:
+            if normalized in self._cache:
+                self._cache.move_to_end(normalized)
+                self.hits += 1
+                return self._cache[normalized]
+
+        embedding = self.__get_from_redis(normalized)
+        if embedding is not None:
+            with self._lock:
+                self.redis_hits += 1
+        else:
+            embedding = self.embeddings.embed_query(normalized)
+            with self._lock:
+                self.misses += 1
+            self.__save_to_redis(normalized, embedding)
+
+        self.__save_to_memory(normalized, embedding)
+        return embedding
+
+    async def aembed_query(self, text:str) -> List[float]:
+        if self.batcher is None:
+            return await super().aembed_query(text)
+
+        normalized = self.normalize(text)
+        with self._lock:
+            if normalized in self._cache:
+                self._cache.move_to_end(normalized)
+                self.hits += 1
+                return self._cache[normalized]
+
+        embedding = None
+        if self.redis_client is not None:
+            embedding = await self.batcher.run_blocking(self.__get_from_redis, normalized)
+        if embedding is not None:
+            with self._lock:
+                self.redis_hits += 1
+        else:
+            embedding = await self.batcher.aembed_query(normalized)
+            with self._lock:
+                self.misses += 1
+            if self.redis_client is not None:
+                await self.batcher.run_blocking(self.__save_to_redis, normalized, embedding)
+
+        self.__save_to_memory(normalized, embedding)
+        return embedding
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters of the cache."""
+        with self._lock:
+            total = self.hits + self.redis_hits + self.misses
+            return {
+                "size": len(self._cache),
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.redis_hits) / total, 4) if total else 0.0
+            }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    @staticmethod
+    def normalize(text:str) -> str:
+        return re.sub(r'\s+', ' ', text.strip().lower())
+
+    def __getattr__(self, name):
+        # Behave like the wrapped model for everything else (e.g. show_progress)
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def __save_to_memory(self, normalized:str, embedding:List[float]):
+        with self._lock:
+            self._cache[normalized] = embedding
+            self._cache.move_to_end(normalized)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def __redis_key(self, normalized:str) -> str:
+        return f"{self.namespace}:{hashlib.sha1(normalized.encode()).hexdigest()}"
+
+    def __get_from_redis(self, normalized:str) -> Optional[List[float]]:
+        if self.redis_client is None:
+            return None
+        try:
+            encoded = self.redis_client.get(self.__redis_key(normalized))
+        except Exception as e:
+            print(f"Embedding cache redis error - {e}")
+            return None
+        if not encoded:
+            return None
+        return decode_vector(encoded).tolist()
+
+    def __save_to_redis(self, normalized:str, embedding:List[float]):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(self.__redis_key(normalized), encode_vector(embedding), ex=self.redis_ttl)
+        except Exception as e:
+            print(f"Embedding cache redis error - {e}")
@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List
+import numpy as np
+from core.vectors import decode_vector, encode_vector, normalize
+import initial
+
+# Sessions whose decoded vectors stay in this worker, least recently recalled ones go first
+MAX_CACHED_SESSIONS = 256
+
+
+@dataclass
+class _SessionMatrix:
+    """In-process copy of one session's normalised question vectors, rows in `fields` order."""
+    fields: List[str]
+    vectors: np.ndarray
+
+    def best(self, query:np.ndarray, top_k:int) -> List[str]:
+        """Fields of the `top_k` closest turns, oldest first."""
+        similarities = self.vectors @ query
+        limit = min(top_k, len(self.fields))
+        best = np.sort(np.argpartition(-similarities, limit - 1)[:limit])
+        return [self.fields[index] for index in best]
+
+
+class EpisodicMemory:
+
+    _matrices:"OrderedDict[str, _SessionMatrix]" = OrderedDict()
+
+    def __init__(self, session_id:str, expiry:int):
+        """
+            Past turns of one session with the embedding of their question, in redis.
+            Turns and vectors are separate hashes keyed by creation time, so a recall scores
+            an in-process matrix and fetches only the turns it picked.
+        """
+        self.turns_key = f"{session_id}:episode_turns"
+        self.vectors_key = f"{session_id}:episode_vectors"
+        self.expiry = expiry
+
+        self.redis_client = initial.REDIS_CLIENT
+        self.top_k:int = initial.EPISODIC_MEMORY['top_k']
+        self.max_turns:int = initial.EPISODIC_MEMORY['max_turns']
+
+    async def add(self, turn:str, embedding:List[float]):
+        """Store a turn against the query embedding it was answered for."""
+        field = f"{time.time():.6f}"
+
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(self.turns_key, field, turn)
+            pipe.hset(self.vectors_key, field, encode_vector(normalize(embedding)))
+            pipe.expire(self.turns_key, self.expiry)
+            pipe.expire(self.vectors_key, self.expiry)
+            pipe.hlen(self.vectors_key)
+            *_, size = await pipe.execute()
+
+        # Keep long sessions bounded, drop the oldest turns first
+        if size > self.max_turns:
+            fields = sorted(await self.redis_client.hkeys(self.vectors_key), key=float)
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.hdel(self.turns_key, *fields[:size - self.max_turns])
+                pipe.hdel(self.vectors_key, *fields[:size - self.max_turns])
+                await pipe.execute()
+
+    async def recall(self, embedding:List[float]) -> List[str]:
+        """The `top_k` most relevant past turns, in the order they happened."""
+        fields = sorted(await self.redis_client.hkeys(self.vectors_key), key=float)
+        if not fields:
+            return []
+
+        matrix = await self.__current_matrix(fields)
+        if not matrix.fields:
+            return []
+        best = await initial.RUN_BLOCKING(matrix.best, normalize(embedding), self.top_k)
+        turns = await self.redis_client.hmget(self.turns_key, best)
+        return [turn for turn in turns if turn]
+
+    async def __current_matrix(self, fields:List[str]) -> _SessionMatrix:
+        """The local matrix, only vectors added since the last recall cross the wire."""
+        matrix = self._matrices.get(self.vectors_key)
+        if matrix is not None and matrix.fields == fields:
+            self._matrices.move_to_end(self.vectors_key)
+            return matrix
+
+        known:Dict[str, np.ndarray] = dict(zip(matrix.fields, matrix.vectors)) if matrix is not None else {}
+        missing = [field for field in fields if field not in known]
+        if missing:
+            encoded = await self.redis_client.hmget(self.vectors_key, missing)
+            known |= {field: raw for field, raw in zip(missing, encoded) if raw}
+
+        matrix = await initial.RUN_BLOCKING(self.__build_matrix, fields, known)
+        self._matrices[self.vectors_key] = matrix
+        self._matrices.move_to_end(self.vectors_key)
+        while len(self._matrices) > MAX_CACHED_SESSIONS:
+            self._matrices.popitem(last=False)
+        return matrix
+
+    def __build_matrix(self, fields:List[str], known:Dict) -> _SessionMatrix:
+        present = [field for field in fields if known.get(field) is not None]
+        vectors = [decode_vector(known[field]) if isinstance(known[field], str) else known[field] for field in present]
+        return _SessionMatrix(
+            fields=present,
+            vectors=np.vstack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+        )
@@ -0,0 +1,111 @@
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from rapidfuzz import fuzz, process, utils
+from core.vectors import normalize, normalize_rows
+import initial
+
+
+class FaqIndex:
+    """
+        In-memory index of one shop's question/answer documents, answering near
+        exact FAQ questions without retrieval or any llm call.
+    """
+
+    _indexes:Dict[str, "FaqIndex"] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, entries:List[Dict[str, str]]):
+        self.config = initial.FAQ_INDEX
+        self.questions:List[str] = [entry['question'] for entry in entries]
+        self.answers:List[str] = [entry['answer'] for entry in entries]
+        self.embeddings:Optional[np.ndarray] = None
+
+    @classmethod
+    def build(cls, tenant:str) -> "FaqIndex":
+        """
+            Reads every json QA document of the config and swaps in the tenant's new index.
+            The config describes the shop it is ingested for, other shops never see its answers.
+        """
+        entries = []
+        for document in (initial.GET_CONFIGS('database') or {}).get('documents', []):
+            if not document.lower().endswith('.json'):
+                continue
+            try:
+                with open(document, "r") as file:
+                    entries.extend(
+                        {'question': qa['question'], 'answer': qa['answer']}
+                        for qa in json.load(file)
+                        if qa.get('question') and qa.get('answer')
+                    )
+            except Exception as e:
+                print(f"Error loading FAQ document: {document} - {e}")
+
+        index = cls(entries)
+        if index.questions and index.config['embedding_check']:
+            embeddings = initial.EMBEDDING_FUNCTION.embed_documents(index.questions)
+            index.embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+        # A question its own text does not reach is shadowed by a duplicate or near duplicate
+        unreachable = [
+            question for position, question in enumerate(index.questions)
+            if (index.match(question) or (None,))[0] != position
+        ]
+        if unreachable:
+            print(f"⚠️ FAQ questions that never match directly for '{tenant}': {unreachable}")
+
+        with cls._lock:
+            cls._indexes[tenant] = index
+        print(f"✅ FAQ index ready for '{tenant}' with {len(index.questions)} questions")
+        return index
+
+    @classmethod
+    def current(cls, tenant:str) -> Optional["FaqIndex"]:
+        return cls._indexes.get(tenant)
+
+    def match(self, query:str) -> Optional[Tuple[int, float]]:
+        """
+            Best fuzzy (index, score) above the division floor, or None.
+            Ties are dropped, a query matching several questions equally is not an FAQ hit.
+            Candidates are found by token set ratio, which scores 100 for any query that merely
+            contains a question, so they are ranked by that score capped by the order-insensitive
+            but symmetric token sort ratio: extra words in the query pull it down.
+        """
+        if not self.questions:
+            return None
+
+        candidates = process.extract(
+            query,
+            self.questions,
+            scorer=fuzz.token_set_ratio,
+            processor=utils.default_process,
+            score_cutoff=initial.FILTERING_MINIMUM_SCORE['document'],
+            limit=None
+        )
+        if not candidates:
+            return None
+
+        # Several questions can share a 100 set ratio, the capped score tells them apart
+        ranked = sorted(
+            (
+                (min(score, fuzz.token_sort_ratio(query, question, processor=utils.default_process)), position)
+                for question, score, position in candidates
+            ),
+            reverse=True
+        )
+        if len(ranked) > 1 and ranked[1][0] >= ranked[0][0]:
+            return None
+        score, position = ranked[0]
+        return position, score
+
+    def is_confident(self, position:int, score:float, query_embedding:Optional[List[float]] = None) -> bool:
+        """High fuzzy score, and when enabled, the query embedding agrees with the stored question."""
+        if score < self.config['direct_score']:
+            return False
+        if self.embeddings is None or query_embedding is None:
+            return not self.config['embedding_check']
+
+        similarity = float(self.embeddings[position] @ normalize(query_embedding))
+        print("FAQ EMBEDDING SCORE.........", round(similarity, 4))
+        return similarity >= self.config['embedding_threshold']
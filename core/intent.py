@@ -0,0 +1,97 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, FrozenSet, Literal, Optional, Pattern
+
+GREETING_TYPES = Literal['greeting', 'nice_to_meet_you', 'how_are_you']
+
+
+@dataclass(frozen=True)
+class Intent:
+    """Immutable result of scanning one message, reused for the whole request."""
+    matches: FrozenSet[str]
+    greeting: Optional[GREETING_TYPES] = None
+    is_user_scoped: bool = False
+    is_cart: bool = False
+    filter_tag: Optional[str] = None
+
+
+class IntentScanner:
+
+    def __init__(self, patterns:Dict[str, str|Pattern]):
+        """
+            Compiles every named pattern once. A scan evaluates each of them at
+            most once per message, lazily, in the order the decisions need them.
+        """
+        self.patterns:Dict[str, Pattern] = {
+            name: re.compile(self.__source(pattern), re.IGNORECASE)
+            for name, pattern in patterns.items()
+        }
+
+    def scan(self, message:str) -> Intent:
+        matched = set()
+        cache:Dict[str, bool] = {}
+
+        def hit(name:str) -> bool:
+            # every pattern runs at most once per message, and only when needed
+            if name not in cache:
+                cache[name] = self.patterns[name].search(message) is not None
+                if cache[name]:
+                    matched.add(name)
+            return cache[name]
+
+        greeting = None
+        if hit('greeting_pattern') or hit('strict_gretting_pattern'):
+            greeting = 'greeting'
+        elif hit('nice_to_meet_you'):
+            greeting = 'nice_to_meet_you'
+        elif hit('how_are_you'):
+            greeting = 'how_are_you'
+
+        # A greeting is answered directly, nothing else is needed
+        if greeting:
+            return Intent(matches=frozenset(matched), greeting=greeting)
+
+        is_user_scoped = (
+            hit('self_reffering_pattern')
+            and hit('entity_pattern')
+            and not hit('exclued_pattern')
+        )
+
+        # Category based tags first to avoid conflicts, then the individual tags
+        filter_tag = None
+        if hit('helper_category_pattern') and not hit('excluding_category_pattern'):
+            if hit('product_pattern'):
+                filter_tag = 'product_category_tag'
+            elif hit('post_pattern'):
+                filter_tag = 'post_category_tag'
+
+        if filter_tag is None:
+            for name, tag in (
+                ('cart_pattern', 'cart_tag'),
+                ('product_pattern', 'product_tag'),
+                ('order_pattern', 'order_tag'),
+                ('post_pattern', 'post_tag'),
+            ):
+                if hit(name):
+                    filter_tag = tag
+                    break
+
+        return Intent(
+            matches=frozenset(matched),
+            is_user_scoped=is_user_scoped,
+            is_cart=hit('cart_pattern'),
+            filter_tag=filter_tag
+        )
+
+    def __source(self, pattern:str|Pattern) -> str:
+        return pattern.pattern if isinstance(pattern, re.Pattern) else pattern
+
+
+@lru_cache(maxsize=1024)
+def user_id_pattern(user_id:int) -> Pattern:
+    """Compiled `customer_id: N` style pattern, built once per user id."""
+    return re.compile(
+        rf"(?:consumers?|customers?|users?|buyers?)(?:s|_id|id)?\s*:\s*\b{user_id}\b",
+        re.IGNORECASE
+    )
@@ -0,0 +1,163 @@
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import initial
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset({
+    "a", "an", "and", "any", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from",
+    "have", "how", "i", "in", "is", "it", "me", "my", "of", "on", "or", "show", "tell", "that",
+    "the", "this", "to", "was", "what", "when", "where", "which", "who", "with", "you", "your"
+})
+
+
+def tokenize(text:str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def reciprocal_rank_fusion(rankings:List[List[str]], k:int = 60) -> List[str]:
+    """Merges several ranked id lists, an id scores `1 / (k + rank)` in every list it appears in."""
+    scores:Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] += 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class KeywordIndex:
+    """
+        BM25 inverted index of one collection division.
+        Postings are stored as flat numpy arrays and memory-mapped when searched,
+        so only the slices of the query terms are ever read.
+    """
+
+    _loaded:Dict[Tuple[str, str], Tuple[float, "KeywordIndex"]] = {}
+
+    def __init__(self, collection_name:str, division:str):
+        self.collection_name = collection_name
+        self.division = division
+        self.k1:float = 1.5
+        self.b:float = 0.75
+
+        self.ids:List[str] = []
+        self.vocabulary:Dict[str, Tuple[int, int, float]] = {}  # term -> (start, end, idf)
+        self.average_length:float = 0.0
+        self.postings_docs:Optional[np.ndarray] = None
+        self.postings_tf:Optional[np.ndarray] = None
+        self.doc_lengths:Optional[np.ndarray] = None
+
+    @property
+    def directory(self) -> str:
+        return os.path.join(initial.KEYWORD_INDEX['directory'], self.collection_name, self.division)
+
+    def build(self) -> "KeywordIndex":
+        """Tokenizes every stored chunk of the division and writes the postings to disk."""
+        vectorstore = initial.VECTOR_DB[self.division](self.collection_name)
+        stored = vectorstore._collection.get(include=['documents'])
+
+        postings:Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        lengths:List[int] = []
+        for position, text in enumerate(stored['documents']):
+            tokens = tokenize(text or "")
+            lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings[term].append((position, frequency))
+
+        total = len(lengths)
+        docs, frequencies, vocabulary = [], [], {}
+        for term in sorted(postings):
+            start = len(docs)
+            for position, frequency in postings[term]:
+                docs.append(position)
+                frequencies.append(frequency)
+            df = len(postings[term])
+            vocabulary[term] = (start, len(docs), math.log(1 + (total - df + 0.5) / (df + 0.5)))
+
+        self.ids = list(stored['ids'])
+        self.vocabulary = vocabulary
+        self.average_length = (sum(lengths) / total) if total else 0.0
+        self.postings_docs = np.asarray(docs, dtype=np.int32)
+        self.postings_tf = np.asarray(frequencies, dtype=np.float32)
+        self.doc_lengths = np.asarray(lengths, dtype=np.float32)
+        self.save()
+        return self
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(os.path.join(self.directory, "postings_docs.npy"), self.postings_docs)
+        np.save(os.path.join(self.directory, "postings_tf.npy"), self.postings_tf)
+        np.save(os.path.join(self.directory, "doc_lengths.npy"), self.doc_lengths)
+
+        # The meta file is written last, its mtime marks a complete index
+        meta_path = os.path.join(self.directory, "meta.json")
+        with open(f"{meta_path}.tmp", "w") as file:
+            json.dump({
+                "ids": self.ids,
+                "vocabulary": self.vocabulary,
+                "average_length": self.average_length
+            }, file)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+        self._loaded.pop((self.collection_name, self.division), None)
+        print(f"✅ Saved keyword index for '{self.collection_name}/{self.division}': {len(self.ids)} chunks, {len(self.vocabulary)} terms")
+
+    @classmethod
+    def load(cls, collection_name:str, division:str) -> Optional["KeywordIndex"]:
+        """Memory-maps the persisted index, reloading when an ingestion run rewrote it."""
+        index = cls(collection_name, division)
+        meta_path = os.path.join(index.directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+
+        modified = os.path.getmtime(meta_path)
+        cached = cls._loaded.get((collection_name, division))
+        if cached and cached[0] == modified:
+            return cached[1]
+
+        with open(meta_path) as file:
+            meta = json.load(file)
+        index.ids = meta['ids']
+        index.vocabulary = {term: tuple(entry) for term, entry in meta['vocabulary'].items()}
+        index.average_length = meta['average_length']
+        index.postings_docs = np.load(os.path.join(index.directory, "postings_docs.npy"), mmap_mode='r')
+        index.postings_tf = np.load(os.path.join(index.directory, "postings_tf.npy"), mmap_mode='r')
+        index.doc_lengths = np.load(os.path.join(index.directory, "doc_lengths.npy"), mmap_mode='r')
+        cls._loaded[(collection_name, division)] = (modified, index)
+        return index
+
+    def search(self, query:str, top_n:int = 20) -> List[Tuple[str, float]]:
+        """Returns the `top_n` (chroma id, bm25 score) pairs sharing at least one term with the query."""
+        terms = [term for term in set(tokenize(query)) if term in self.vocabulary]
+        if not terms or not self.ids:
+            return []
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in terms:
+            start, end, idf = self.vocabulary[term]
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end]
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / (self.average_length or 1))
+            # a term appears once per document in its postings, so plain fancy indexing is safe
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        limit = min(top_n, len(matched))
+        best = matched[np.argpartition(-scores[matched], limit - 1)[:limit]]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(self.ids[position], float(scores[position])) for position in best]
+
+    def has_exact_match(self, query:str) -> bool:
+        """True when the query carries a rare indexed token, like a SKU, an order number or a product name."""
+        rare_df = initial.KEYWORD_INDEX['rare_df']
+        for term in set(tokenize(query)):
+            if term in self.vocabulary:
+                start, end, _ = self.vocabulary[term]
+                if end - start <= rare_df:
+                    return True
+        return False
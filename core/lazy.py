@@ -0,0 +1,80 @@
+import threading
+import time
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, List, MutableMapping as MutableMappingType
+
+
+class LazyResources:
+
+    def __init__(self, namespace:MutableMappingType[str, Any]):
+        """
+            Named resources created on first use, at most once even when threads race for them.
+            A created resource is written into `namespace` (a module's globals), so later
+            attribute lookups no longer go through the module `__getattr__`.
+        """
+        self.namespace = namespace
+        self.factories:Dict[str, Callable[[], Any]] = {}
+        self.locks:Dict[str, threading.Lock] = {}
+        self.init_times:Dict[str, float] = {}  # seconds spent in each factory
+
+    def register(self, name:str) -> Callable[[Callable[[], Any]], Callable[[], Any]]:
+        def decorator(factory:Callable[[], Any]) -> Callable[[], Any]:
+            self.factories[name] = factory
+            self.locks[name] = threading.Lock()
+            return factory
+        return decorator
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.factories)
+
+    def get(self, name:str) -> Any:
+        if name in self.namespace:
+            return self.namespace[name]
+        if name not in self.factories:
+            raise AttributeError(f"no attribute or lazy resource named {name!r}")
+
+        with self.locks[name]:
+            # Another thread may have finished it while this one waited
+            if name not in self.namespace:
+                started = time.perf_counter()
+                self.namespace[name] = self.factories[name]()
+                self.init_times[name] = time.perf_counter() - started
+                print(f"⚙️ Initialised {name} in {self.init_times[name] * 1000:.0f}ms")
+        return self.namespace[name]
+
+
+class LazyMapping(MutableMapping):
+
+    def __init__(self, factories:Dict[str, Callable[[], Any]], init_times:Dict[str, float], prefix:str):
+        """Mapping whose values are built by their factory on first access, keys are known upfront."""
+        self.factories = factories
+        self.init_times = init_times
+        self.prefix = prefix
+        self.values:Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key:str) -> Any:
+        if key not in self.values:
+            with self.lock:
+                if key not in self.values:
+                    started = time.perf_counter()
+                    self.values[key] = self.factories[key]()
+                    self.init_times[f"{self.prefix}.{key}"] = time.perf_counter() - started
+        return self.values[key]
+
+    def is_created(self, key:str) -> bool:
+        return key in self.values
+
+    def __setitem__(self, key:str, value:Any):
+        self.values[key] = value
+
+    def __delitem__(self, key:str):
+        self.values.pop(key, None)
+        self.factories.pop(key, None)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(dict.fromkeys([*self.factories, *self.values]))
+
+    def __len__(self) -> int:
+        return len(dict.fromkeys([*self.factories, *self.values]))
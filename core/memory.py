@@ -1,82 +1,189 @@
+import base64
+import time
+import traceback
+import zlib
+from functools import partial
+from typing import Dict, List, Set
 from langchain.chains.summarize import load_summarize_chain
 from langchain.docstore.document import Document
 import initial
 
+COMPRESSED_PREFIX = "zlib:"
+
 
 class CustomChatMemory:
-    
+
     def __init__(self, user_id, expiry=6000):
-        """Initialize Redis client and expiry settings."""
-        self.user_summary_key = f"{user_id}:last_summary"
-        self.user_last_message_key = f"{user_id}:last_message"
-        self.user_last_filter_tag_key = f"{user_id}:last_filter_tag"
-        self.user_last_division = f"{user_id}:last_division"
+        """
+            Session state kept in one redis hash. It is read once with HGETALL,
+            changed in memory, and only the changed fields are written back by `flush`.
+            Unsummarized turns are a redis list next to it, appended with RPUSH, so
+            concurrent turns of one session never overwrite each other.
+        """
+        self.session_key = f"{user_id}:session"
+        self.turns_key = f"{user_id}:turns"
 
         self.redis_client = initial.REDIS_CLIENT
-        self.expiry = expiry  # Expiry in seconds (default: 5 minutes)
+        self.expiry = expiry  # Expiry in seconds (default: 100 minutes)
+
+        self.state:Dict[str, str] = {}
+        self.turns:List[str] = []
+        self.dirty:Set[str] = set()
+        self.loaded = False
+
+    async def load(self):
+        """Read the whole session in a single round trip."""
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.session_key)
+            pipe.lrange(self.turns_key, 0, -1)
+            raw_state, raw_turns = await pipe.execute()
+        # Fields changed before the load win over the stored ones
+        self.state = {
+            field: self.__decompress(value) for field, value in raw_state.items()
+        } | {field: self.state[field] for field in self.dirty}
+        self.turns = [self.__decompress(turn) for turn in raw_turns]
+        self.loaded = True
+
+    async def flush(self):
+        """Write the changed fields and refresh the expiry in one pipeline."""
+        if not self.dirty:
+            return
+
+        mapping = {field: self.__compress(self.state[field]) for field in self.dirty}
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(self.session_key, mapping=mapping)
+            pipe.expire(self.session_key, self.expiry)
+            pipe.expire(self.turns_key, self.expiry)
+            await pipe.execute()
+        self.dirty.clear()
 
     async def get_conversation(self):
-        """Retrieve the summarized conversation"""
-        summary_coroutine = self.redis_client.get(self.user_summary_key)
-        summary = await summary_coroutine if summary_coroutine else ""
-        return summary
-  
+        """Summary of the older turns followed by the raw turns not summarized yet."""
+        summary = await self.__get('last_summary')
+        return "\n".join([summary] + self.turns).strip()
+
     async def get_last_message(self):
         """Retrieve the last saved message."""
-        message_coroutine = self.redis_client.get(self.user_last_message_key)
-        last_message = await message_coroutine if message_coroutine else ""
-        return last_message
-  
+        return await self.__get('last_message')
+
     async def get_last_filter_tag(self):
         """Retrieve the last saved filter tag."""
-        filter_tag_coroutine = self.redis_client.get(self.user_last_filter_tag_key)
-        last_filter_tag = await filter_tag_coroutine if filter_tag_coroutine else ""
-        return last_filter_tag
-  
+        return await self.__get('last_filter_tag')
+
     async def get_last_division(self):
         """Retrieve the last saved division."""
-        division_coroutine = self.redis_client.get(self.user_last_division)
-        last_division = await division_coroutine if division_coroutine else ""
-        return last_division
+        return await self.__get('last_division')
 
     async def add_filter_tag(self, filter_tag:str):
-        await self.redis_client.set(self.user_last_filter_tag_key, filter_tag, ex=self.expiry)
+        self.__set('last_filter_tag', filter_tag)
 
     async def add_division(self, division:str):
-        await self.redis_client.set(self.user_last_division, division, ex=self.expiry)
+        self.__set('last_division', division)
+
+    async def add_memory(self, user_message: str, bot_response: str, record_turn: bool = True):
+        """
+            Store the last message and buffer the turn. The buffered turns are summarized
+            in one llm call once they cross the token threshold, or when the session goes idle.
+        """
 
-    async def add_memory(self, user_message: str, bot_response: str):
-        """Store the last message and update the summary."""
+        self.__set('last_message', user_message)
+        if not record_turn:
+            return await self.flush()
 
-        # Save last message (replace old one)
-        await self.redis_client.set(self.user_last_message_key, user_message, ex=self.expiry)
+        self.__set('last_active', str(time.time()))
+        mapping = {field: self.__compress(self.state[field]) for field in self.dirty}
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(self.session_key, mapping=mapping)
+            pipe.rpush(self.turns_key, self.__compress(f"User: {user_message} | Bot: {bot_response}"))
+            pipe.expire(self.session_key, self.expiry)
+            pipe.expire(self.turns_key, self.expiry)
+            pipe.lrange(self.turns_key, 0, -1)
+            *_, raw_turns = await pipe.execute()
+        self.dirty.clear()
+        self.turns = [self.__decompress(turn) for turn in raw_turns]
 
-        # Retrieve existing summary
-        old_summary = await self.get_conversation()
-        
-        # Generate a new summary combining old summary + latest conversation
-        conversation = f"User: {user_message} | Bot: {bot_response}"
-        new_summary = await self.summarize_text(old_summary, conversation)
-        
-        # Save updated summary (replace old one)
-        await self.redis_client.set(self.user_summary_key, new_summary, ex=self.expiry)
+        # One summary job per session, a newer turn replaces the one still waiting
+        try:
+            buffered_tokens = await initial.RUN_BLOCKING(initial.COUNT_TOKENS, "\n".join(self.turns))
+        except Exception:
+            # Unknown size, summarizing now keeps the buffer from growing without bound
+            traceback.print_exc()
+            buffered_tokens = initial.MEMORY['summary_token_threshold']
+        if buffered_tokens >= initial.MEMORY['summary_token_threshold']:
+            job, delay = self.summarize_turns, 0
+        else:
+            job, delay = partial(self.__summarize_if_idle, self.state['last_active']), initial.MEMORY['idle_seconds']
+        initial.BACKGROUND_TASKS.submit(job, name="summary", key=f"summary:{self.session_key}", delay=delay)
+
+    async def summarize_turns(self):
+        """Folds every buffered turn into the summary with a single llm call."""
+        # Another worker folding the same turns would drop the ones appended after them
+        lock_key = f"{self.session_key}:summarizing"
+        if not await self.redis_client.set(lock_key, "1", nx=True, ex=120):
+            return
+        try:
+            await self.flush()
+            await self.load()
+            turns = list(self.turns)
+            if not turns:
+                return
+
+            new_summary = await self.summarize_text(self.state.get('last_summary') or "", "\n".join(turns))
+
+            # Turns appended while the llm was busy are after these, they stay in the list
+            self.__set('last_summary', new_summary)
+            mapping = {field: self.__compress(self.state[field]) for field in self.dirty}
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(self.session_key, mapping=mapping)
+                pipe.ltrim(self.turns_key, len(turns), -1)
+                pipe.expire(self.session_key, self.expiry)
+                await pipe.execute()
+            self.dirty.clear()
+            self.turns = self.turns[len(turns):]
+        finally:
+            await self.redis_client.delete(lock_key)
 
     async def summarize_text(self, old_summary: str, new_chat: str):
         """Summarize given conversations using LangChain with a strict 300-word limit."""
         chain = load_summarize_chain(
-            initial.MODELS['small'], 
+            await initial.RESOLVE("MODELS.small"),
             chain_type="stuff",
         )
-        
+
         # Combine old summary with new chat history
         prompt = initial.PRE_PROMPTS['memory'].format(
             old_summary=old_summary,
             input_text = new_chat
         )
-        
+
         docs = [Document(page_content=prompt)]
         response = await chain.ainvoke({"input_documents": docs})
         summary = response["output_text"]
-        
-        return summary  
 
+        return summary
+
+    async def __summarize_if_idle(self, last_active:str):
+        # A newer turn from another worker means the session is still active
+        await self.load()
+        if self.state.get('last_active') == last_active:
+            await self.summarize_turns()
+
+    async def __get(self, field:str) -> str:
+        if not self.loaded:
+            await self.load()
+        return self.state.get(field) or ""
+
+    def __set(self, field:str, value:str):
+        self.state[field] = value
+        self.dirty.add(field)
+
+    def __compress(self, value:str) -> str:
+        # Only large values are worth the cpu, small ones stay readable in redis
+        if not initial.MEMORY['compress'] or len(value) < initial.MEMORY['compress_min_size']:
+            return value
+        return COMPRESSED_PREFIX + base64.b64encode(zlib.compress(value.encode(), 6)).decode()
+
+    def __decompress(self, value:str) -> str:
+        if not value.startswith(COMPRESSED_PREFIX):
+            return value
+        return zlib.decompress(base64.b64decode(value[len(COMPRESSED_PREFIX):])).decode()
@@ -0,0 +1,144 @@
+from typing import Any, Dict, List, Optional
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from core.vectors import normalize, normalize_rows
+
+
+def _prune(similarity_to_query:np.ndarray, k:int, lambda_mult:float) -> np.ndarray:
+    """
+        Indices of the candidates that can still be picked in the first k steps.
+        A top-k candidate always scores at least `λ·q_k - (1-λ)`, and any other candidate
+        scores at most `λ·q + (1-λ)`, so everything below `q_k - 2(1-λ)/λ` can be dropped.
+    """
+    count = len(similarity_to_query)
+    if lambda_mult <= 0 or k >= count:
+        return np.arange(count)
+
+    kth_best = np.partition(similarity_to_query, count - k)[count - k]
+    cutoff = kth_best - 2 * (1 - lambda_mult) / lambda_mult - 1e-6
+    return np.flatnonzero(similarity_to_query >= cutoff)
+
+
+def mmr_select(
+    query_embedding:np.ndarray,
+    candidates:np.ndarray,
+    k:int = 4,
+    lambda_mult:float = 0.5,
+    mask:Optional[np.ndarray] = None
+) -> List[int]:
+    """
+        Maximal marginal relevance over a float32 candidate matrix.
+        Returns the same indices as LangChain's `maximal_marginal_relevance`, but keeps
+        a running max-similarity vector instead of recomputing it every step.
+        `mask` excludes candidates (False) before selection.
+    """
+    candidates = normalize_rows(np.asarray(candidates, dtype=np.float32))
+    query = normalize(query_embedding)
+
+    allowed = np.arange(len(candidates)) if mask is None else np.flatnonzero(mask)
+    k = min(k, len(allowed))
+    if k <= 0:
+        return []
+
+    similarity_to_query = candidates[allowed] @ query
+    if lambda_mult >= 1:
+        # Pure relevance, a partial top-k is enough
+        top = np.argpartition(-similarity_to_query, k - 1)[:k]
+        top = top[np.argsort(-similarity_to_query[top], kind="stable")]
+        return allowed[top].tolist()
+
+    keep = _prune(similarity_to_query, k, lambda_mult)
+    allowed, similarity_to_query = allowed[keep], similarity_to_query[keep]
+    pool = candidates[allowed]
+
+    relevance = lambda_mult * similarity_to_query
+    max_similarity = np.full(len(allowed), -np.inf, dtype=np.float32)
+    selected:List[int] = []
+
+    position = int(np.argmax(similarity_to_query))
+    while True:
+        selected.append(position)
+        if len(selected) == k:
+            break
+
+        # One mat-vec per step keeps the redundancy of every candidate up to date
+        np.maximum(max_similarity, pool @ pool[position], out=max_similarity)
+        scores = relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        position = int(np.argmax(scores))
+
+    return allowed[selected].tolist()
+
+
+def mmr_select_batch(
+    query_embeddings:np.ndarray,
+    candidates:np.ndarray,
+    k:int = 4,
+    lambda_mult:float = 0.5,
+    masks:Optional[np.ndarray] = None
+) -> List[List[int]]:
+    """MMR for a batch of queries sharing one candidate matrix, all queries step together."""
+    candidates = normalize_rows(np.asarray(candidates, dtype=np.float32))
+    queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+    batch, count = len(queries), len(candidates)
+    allowed = np.ones((batch, count), dtype=bool) if masks is None else np.asarray(masks, dtype=bool)
+
+    similarity_to_query = queries @ candidates.T
+    relevance = np.where(allowed, lambda_mult * similarity_to_query, -np.inf)
+    max_similarity = np.full((batch, count), -np.inf, dtype=np.float32)
+    limits = np.minimum(allowed.sum(axis=1), k)
+    rows = np.arange(batch)
+
+    selected = np.full((batch, int(limits.max(initial=0))), -1, dtype=np.int64)
+    positions = np.argmax(np.where(allowed, similarity_to_query, -np.inf), axis=1)
+    for step in range(selected.shape[1]):
+        active = step < limits
+        selected[active, step] = positions[active]
+        relevance[rows[active], positions[active]] = -np.inf
+        if step + 1 == selected.shape[1]:
+            break
+
+        np.maximum(max_similarity, (candidates[positions] @ candidates.T), out=max_similarity)
+        scores = relevance - (1 - lambda_mult) * max_similarity
+        positions = np.argmax(scores, axis=1)
+
+    return [selected[row, :limits[row]].tolist() for row in range(batch)]
+
+
+def mmr_search_by_vector(
+    vectorstore:Chroma,
+    embedding:List[float],
+    k:int = 4,
+    fetch_k:int = 20,
+    lambda_mult:float = 0.5,
+    filter:Optional[Dict[str, Any]] = None,
+    where_document:Optional[Dict[str, Any]] = None,
+    **kwargs:Any
+) -> List[Document]:
+    """Drop-in for `Chroma.max_marginal_relevance_search_by_vector` using `mmr_select`."""
+    results = vectorstore._collection.query(
+        query_embeddings=[embedding],
+        n_results=fetch_k,
+        where=filter,
+        where_document=where_document,
+        include=['metadatas', 'documents', 'embeddings'],
+        **kwargs
+    )
+    if not results['ids'] or not results['ids'][0]:
+        return []
+
+    indices = mmr_select(
+        np.asarray(embedding, dtype=np.float32),
+        np.asarray(results['embeddings'][0], dtype=np.float32),
+        k=k,
+        lambda_mult=lambda_mult
+    )
+    return [
+        Document(
+            id=results['ids'][0][index],
+            page_content=results['documents'][0][index],
+            metadata=results['metadatas'][0][index] or {}
+        )
+        for index in indices
+    ]
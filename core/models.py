@@ -1,7 +1,17 @@
-from pydantic import BaseModel
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
 
 
 # Define input model
 class ChatInput(BaseModel):
     message: str
-    session_id: str
\ No newline at end of file
+    session_id: str
+    # shop collection, defaults to initial.COLLECTION_NAME, follows chroma's collection naming rules
+    tenant: Optional[str] = Field(default=None, pattern=r"^[A-Za-z0-9][A-Za-z0-9._-]{1,61}[A-Za-z0-9]$")
+
+
+# Routing decision returned by the single routing LLM call
+class RoutingDecision(BaseModel):
+    is_follow_up: bool = False
+    division: Literal['database', 'document', 'website'] = 'database'
+    filter_tag: Optional[str] = None
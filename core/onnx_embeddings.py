@@ -0,0 +1,97 @@
+import os
+from typing import List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+ONNX_FILE = "model.onnx"
+QUANTIZED_ONNX_FILE = "model_quantized.onnx"
+
+
+class OnnxEmbeddings(Embeddings):
+
+    def __init__(
+        self,
+        model_directory:str,
+        file_name:str = QUANTIZED_ONNX_FILE,
+        batch_size:int = 8,
+        max_length:int = 384,
+        threads:Optional[int] = None
+    ):
+        """
+            Sentence embeddings from an exported transformer run on onnxruntime.
+            Mean pooling over the attention mask and L2 normalization, the same
+            as sentence-transformers does for all-mpnet-base-v2.
+        """
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.batch_size = batch_size
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_directory, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        pad_token = "<pad>" if self.tokenizer.token_to_id("<pad>") is not None else "[PAD]"
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token) or 0, pad_token=pad_token)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_directory, file_name),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        vectors = [
+            self.__embed_batch(texts[start:start + self.batch_size])
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        return np.vstack(vectors).tolist() if vectors else []
+
+    def embed_query(self, text:str) -> List[float]:
+        return self.__embed_batch([text])[0].tolist()
+
+    def __embed_batch(self, texts:List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        token_embeddings = self.session.run(None, inputs)[0]
+
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled / np.clip(norms, 1e-12, None)
+
+
+def export_onnx(model_name:str, model_directory:str, quantize:bool = True) -> str:
+    """
+        Exports `model_name` to `model_directory` with its tokenizer and, by default,
+        writes a dynamically int8 quantized copy next to it. Needs `optimum[onnxruntime]`,
+        which is only required for exporting, not for serving.
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+    except ImportError as exc:
+        raise ImportError("Exporting to onnx needs `pip install optimum[onnxruntime]`") from exc
+
+    ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(model_directory)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(model_directory)
+    if not quantize:
+        return os.path.join(model_directory, ONNX_FILE)
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = os.path.join(model_directory, QUANTIZED_ONNX_FILE)
+    quantize_dynamic(
+        os.path.join(model_directory, ONNX_FILE),
+        quantized_path,
+        weight_type=QuantType.QInt8
+    )
+    return quantized_path
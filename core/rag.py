@@ -2,20 +2,32 @@ import json
 from pdb import run
 import re
 import traceback
-import asyncio
-from typing import Any, AsyncIterator, List, Literal, Optional
+import time
+from functools import partial
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional
 
-from langchain_chroma import Chroma
-from langchain.chains.retrieval_qa.base import RetrievalQA
+from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR
 from langchain.schema import Document, BaseRetriever
 from langchain.chains.retrieval import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.language_models import BaseChatModel
 from core.api_loader import PLATFORM_TYPES, ApiLoader
+from core.context_packer import ContextPacker, PackStats
+from core.cross_encoder import CrossEncoderReranker
+from core.division_classifier import DivisionClassifier
+from core.episodic_memory import EpisodicMemory
+from core.faq_index import FaqIndex
+from core.intent import Intent, user_id_pattern
+from core.keyword_index import KeywordIndex, reciprocal_rank_fusion
 from core.memory import CustomChatMemory
-from core.models import ChatInput
+from core.mmr import mmr_search_by_vector
+from core.models import ChatInput, RoutingDecision
+from core.reranker import EmbeddingReranker
+from core.semantic_cache import SemanticCache
+from core.single_flight import SingleFlight
+from core.timing import StageTimer, TimingLog
+from core.vector_registry import UnknownCollection
 import initial
-from langchain_core.runnables import RunnableLambda 
 
 
 
@@ -29,14 +41,79 @@ class DummyRetriever(BaseRetriever):
 
     def _get_relevant_documents(self, query: str) -> list[Document]:
         return self.filtered_docs
-    
+
+
+class VectorRetriever(BaseRetriever):
+    """MMR retriever searching with a precomputed query embedding."""
+    vectorstore: Any
+    embedding: List[float]
+    search_kwargs: dict = {}
+
+    def _get_relevant_documents(self, query: str) -> list[Document]:
+        return mmr_search_by_vector(
+            self.vectorstore,
+            self.embedding, 
+            **self.search_kwargs
+        )
+
+    def candidates(self) -> list[Document]:
+        """The whole first stage, the `fetch_k` nearest documents under the filter, before MMR."""
+        return self.vectorstore.similarity_search_by_vector(
+            self.embedding,
+            k=self.search_kwargs.get('fetch_k', 20),
+            filter=self.search_kwargs.get('filter')
+        )
+
+
+class HybridRetriever(VectorRetriever):
+    """Fuses the MMR results with BM25 keyword hits by reciprocal rank fusion."""
+    keyword_ids: List[str] = []
+
+    def _get_relevant_documents(self, query: str) -> list[Document]:
+        vector_docs = super()._get_relevant_documents(query)
+        documents, allowed_ids = self.__with_keyword_docs(vector_docs)
+
+        fused_ids = reciprocal_rank_fusion(
+            [[doc.id for doc in vector_docs], [doc_id for doc_id in self.keyword_ids if doc_id in allowed_ids]],
+            k=initial.KEYWORD_INDEX['rrf_k']
+        )
+        return [documents[doc_id] for doc_id in fused_ids[:self.search_kwargs.get('k', 4)]]
+
+    def candidates(self) -> list[Document]:
+        vector_docs = super().candidates()
+        documents, _ = self.__with_keyword_docs(vector_docs)
+        return list(documents.values())
+
+    def __with_keyword_docs(self, vector_docs:list[Document]):
+        documents = {doc.id: doc for doc in vector_docs}
+
+        # Keyword hits still have to pass the same metadata filter as the vector search
+        missing_ids = [doc_id for doc_id in self.keyword_ids if doc_id not in documents]
+        allowed_ids = set(documents)
+        if missing_ids:
+            stored = self.vectorstore._collection.get(
+                ids=missing_ids,
+                where=self.search_kwargs.get('filter'),
+                include=['metadatas', 'documents']
+            )
+            for doc_id, content, metadata in zip(stored['ids'], stored['documents'], stored['metadatas']):
+                documents[doc_id] = Document(id=doc_id, page_content=content, metadata=metadata or {})
+            allowed_ids.update(stored['ids'])
+        return documents, allowed_ids
+
 
 class Rag:
     userId:Optional[int] = None 
     is_userId_attached:Optional[bool] = False
     filter_tag:Optional[str] = None
+    filter_tag_resolved:bool = False
     is_followUp:bool = False
+    routing:Optional[RoutingDecision] = None
     pre_prompt_message:str = ""
+    has_context:bool = False
+    time_to_first_token:Optional[float] = None
+    total_time:Optional[float] = None
+    context_stats:Optional[PackStats] = None
     first_limit:int = 400
     second_limit:int = 50
     empty_document = [
@@ -47,75 +124,203 @@ class Rag:
     ]
     
 
-    def __init__(self, input:ChatInput) -> None:
+    def __init__(self, input:ChatInput, customer_id:Optional[int] = None) -> None:
+        self.started_at = time.perf_counter()
         self.input:ChatInput = input
         self.input.message = input.message.strip().lower()
         self.message = self.input.message
+
+        # Monotonic duration of every stage, reported as Server-Timing
+        self.timer = StageTimer(self.input.session_id)
+
+        # Greetings, user scoping and filter tags detected in one pass
+        with self.timer.stage('intent'):
+            self.intent: Intent = initial.INTENT_SCANNER.scan(self.input.message)
         
         self.platform:PLATFORM_TYPES = initial.PLATFORM_NAME
-        self.userId = 26 #{'wordpress':1, 'woocommerce':20, 'mysql':20, 'sqlite':2}
+        self.tenant:str = self.input.tenant or initial.COLLECTION_NAME
+        # Verified by the caller, the request body cannot choose whose orders are read
+        self.userId = customer_id
         self.base_url = 'http://localhost:10003/'
         
         # Initialise memory
-        self.memory: CustomChatMemory = CustomChatMemory(self.input.session_id)
+        # Sessions are namespaced per shop
+        session_id = f"{self.tenant}:{self.input.session_id}"
+        self.memory: CustomChatMemory = CustomChatMemory(session_id)
+        self.episodic_memory: Optional[EpisodicMemory] = None
+        if initial.EPISODIC_MEMORY['enabled']:
+            self.episodic_memory = EpisodicMemory(session_id, self.memory.expiry)
+
+        # Query embeddings computed during this request, keyed by text
+        self.query_embeddings: Dict[str, List[float]] = {}
      
      
     async def invoke(self) -> str:
+        """Runs the pipeline and returns the complete answer."""
+        return "".join([chunk async for chunk in self.astream()])
+
+    async def astream(self) -> AsyncIterator[str]:
+        """Runs the pipeline and yields the answer token by token as the llm produces it."""
+        response_parts: List[str] = []
         try:           
             # Attaching user id
             self.__attach_userId()
-            response = await self._response_pipeline()
-
-            if response:
-                # Summarizing new memory and saving it asynchronously
-                asyncio.create_task(
-                    self.memory.add_memory(
-                        self.message, 
-                        response
-                    )
-                )
-            return self._stream(response or initial.FALLBACK_MESSAGE)
+
+            # The whole session state in one round trip
+            with self.timer.stage('memory_load'):
+                await self.memory.load()
+
+            async for chunk in self._response_pipeline():
+                if not chunk:
+                    continue
+                if not response_parts:
+                    self.time_to_first_token = time.perf_counter() - self.started_at
+                    self.timer.mark('ttft')
+                    print(f"TIME TO FIRST TOKEN.......... {self.time_to_first_token * 1000:.0f}ms")
+                response_parts.append(chunk)
+                yield chunk
+
+            response = "".join(response_parts)
+            if not response:
+                yield initial.FALLBACK_MESSAGE
+
+            # Summarizing new memory and flushing the session state asynchronously
+            initial.BACKGROUND_TASKS.submit(
+                partial(self.__write_memory, response),
+                name="memory",
+                droppable=False
+            )
         except Exception:
             traceback.print_exc()
-            return self._stream(initial.FALLBACK_MESSAGE)
-
-    async def _response_pipeline(self) -> str:
+            if not response_parts:
+                yield initial.FALLBACK_MESSAGE
+        finally:
+            self.total_time = time.perf_counter() - self.started_at
+            self.timer.mark('total')
+            TimingLog.add(self.timer)
+
+    async def _response_pipeline(self) -> AsyncIterator[str]:
         # Handle greeting prompts
         if greeting_response := self.__greeting_handler():
-            return greeting_response
-
-        # detect follow up prompts
-        self.is_followUp = await self.__detect_follow_up_query()
-        print("IS FOLLLOW UP..........", self.is_followUp)
+            yield greeting_response
+            return
+
+        # Personal questions are never answered from other customers' data
+        if self.intent.is_user_scoped and not self.userId:
+            yield initial.LOGIN_MESSAGE
+            return
+
+        # Near exact FAQ questions get their stored answer, no llm call at all
+        if faq_response := await self.__faq_handler():
+            yield faq_response
+            return
+
+        # detect follow up, division and filter tag in a single llm call
+        self.routing = await self.__route_query()
+        self.is_followUp = self.routing.is_follow_up
+        print("ROUTING..........", self.routing)
         print("IS USER ATTACHED...............", self.is_userId_attached, self.userId)
-        
+
+        # Serve repeated non personal questions from the semantic cache
+        semantic_cache = self.__get_semantic_cache()
+        query_embedding = None
+        if semantic_cache:
+            query_embedding = await self._embed_query(self.input.message)
+            with self.timer.stage('semantic_cache'):
+                cached_response = await semantic_cache.lookup(query_embedding)
+            if cached_response:
+                print("SEMANTIC CACHE HIT..........", self.input.message)
+                yield cached_response
+                return
+
+        # Identical questions asked at the same time share one pipeline run
+        if single_flight := await self.__get_single_flight():
+            await self.__record_shared_routing()
+            async for token in single_flight.stream(lambda: self._answer_pipeline(semantic_cache, query_embedding)):
+                yield token
+            return
+
+        async for token in self._answer_pipeline(semantic_cache, query_embedding):
+            yield token
+
+    async def _answer_pipeline(self, semantic_cache:Optional[SemanticCache], query_embedding:Optional[List[float]]) -> AsyncIterator[str]:
         # Handle cart related prompts
-        cart_retriever = await self._handle_cart_enquiry()
+        with self.timer.stage('cart'):
+            cart_retriever = await self._handle_cart_enquiry()
         if cart_retriever:
             division, retriever = cart_retriever
         else:
-            division, retriever = await self._smart_retriever()
+            with self.timer.stage('retriever'):
+                division, retriever = await self._smart_retriever()
         
         # refine the retriever
         if division is not None:
-            retriever = await self._refine_retriever(division, retriever)
-
-        response = await self._retrieve_response(retriever=retriever)
-        return response
+            with self.timer.stage('refine'):
+                retriever = await self._refine_retriever(division, retriever)
+            with self.timer.stage('rerank'):
+                retriever = await self._rerank_retriever(retriever)
+
+        response_parts: List[str] = []
+        async for token in self._retrieve_response(retriever=retriever, division=division):
+            response_parts.append(token)
+            yield token
+
+        response = "".join(response_parts)
+        if semantic_cache and response and self.has_context:
+            await semantic_cache.add(self.input.message, query_embedding, response)
         
-    async def _retrieve_response(self, retriever) -> str:
-        await self.__attach_pre_prompt()
-        print("DOC..................", retriever.invoke(input=self.message))
-        # Create a RetrievalQA Chain
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=initial.MODELS['vision'], 
-            chain_type="stuff", 
-            retriever=retriever,
-            return_source_documents=True,
+    async def _retrieve_response(self, retriever, division:Optional[DIVISION_TYPE] = None) -> AsyncIterator[str]:
+        with self.timer.stage('prompt'):
+            await self.__attach_pre_prompt()
+
+        # Retrieve once off the event loop, the chain only stuffs the documents
+        with self.timer.stage(f"retrieve_{division or 'fallback'}"):
+            relevant_docs = await initial.RUN_BLOCKING(retriever.invoke, self.message)
+        print("DOC..................", relevant_docs)
+        self.has_context = any(
+            doc.page_content != self.empty_document[0].page_content for doc in relevant_docs
+        )
+
+        llm:BaseChatModel = await initial.RESOLVE("MODELS.vision")
+        if self.has_context and initial.CONTEXT_PACKER['enabled']:
+            with self.timer.stage('pack'):
+                relevant_docs = await self._pack_context(relevant_docs, division)
+
+        # Same "stuff" prompt RetrievalQA used, but as a streamable chain
+        qa_chain = create_stuff_documents_chain(
+            llm=llm,
+            prompt=PROMPT_SELECTOR.get_prompt(llm)
         )
 
-        invoked_response = qa_chain.invoke({'query': self.pre_prompt_message})
-        return invoked_response.get('result')  
+        # Measured by hand, a `with` around the yields would also time the consumer
+        llm_started = time.perf_counter()
+        llm_time = 0.0
+        async for token in qa_chain.astream({
+            'context': relevant_docs or self.empty_document,
+            'question': self.pre_prompt_message
+        }):
+            resumed = time.perf_counter()
+            if 'llm_ttft' not in self.timer.stages:
+                self.timer.record('llm_ttft', resumed - llm_started)
+            llm_time += resumed - llm_started
+            yield token
+            llm_started = time.perf_counter()
+        self.timer.record('llm', llm_time + time.perf_counter() - llm_started)
+
+    async def _pack_context(self, relevant_docs:List[Document], division:Optional[DIVISION_TYPE]) -> List[Document]:
+        """Drops duplicate chunks and keeps the documents within the division's token budget."""
+        packer = ContextPacker(division or '', initial.COUNT_TOKENS)
+        try:
+            packed_docs, self.context_stats = await initial.RUN_BLOCKING(packer.pack, relevant_docs)
+        except Exception:
+            # An unpacked context is still a valid answer, only a longer prompt
+            traceback.print_exc()
+            return relevant_docs
+        print(
+            f"CONTEXT PACKED........ {self.context_stats.documents_out}/{self.context_stats.documents_in} docs, "
+            f"{self.context_stats.tokens_out} tokens ({self.context_stats.tokens_saved} saved)"
+        )
+        return packed_docs
 
     async def _handle_cart_enquiry(self):
         if self.platform not in ['wordpress', 'shopify']:
@@ -162,22 +367,10 @@ class Rag:
             retriever = await self._get_retriever("database")
             division = "database"
         else:
-            results = await asyncio.gather(
-                self.__find_division_type(),
-                self._retrieve_documents_parallely()
-            )
-            division, merged_retrievers = results
+            # division is already decided by the routing call
+            division = self.routing.division
             print("DIVISION..................", division)
-            
-            if 'database' in division:
-                division = 'database'
-                retriever = merged_retrievers[0]
-            elif 'document' in division:
-                division = 'document'
-                retriever = merged_retrievers[1]
-            else:
-                division = 'website'
-                retriever = merged_retrievers[2]
+            retriever = await self._get_retriever(division)
         
         await self.memory.add_division(division or '')
         return division, retriever
@@ -189,37 +382,57 @@ class Rag:
         if not (self.is_userId_attached and self.userId):
             return retriever
 
-        relevant_docs = retriever.invoke(input=self.message) 
+        # First stage is every candidate the search fetched, not just the final top-k
+        relevant_docs = await initial.RUN_BLOCKING(self.__first_stage, retriever)
+        if not relevant_docs:
+            # Collections ingested before customer metadata existed, search without the pre-filter
+            retriever = await self._get_retriever(division, scope_to_user=False)
+            relevant_docs = await initial.RUN_BLOCKING(self.__first_stage, retriever)
+
         self.__limit_setter('first', set_limit=len(relevant_docs))
         print("FIRST FILTER......................\n", relevant_docs)
 
-        # User ID base filtering
+        # User ID base filtering, pre-filtered documents already carry the customer id
         filtered_docs: list[Document] = []
 
-        userId_key_value_pattern = rf"(?:consumers?|customers?|users?|buyers?)(?:s|_id|id)?\s*:\s*\b{self.userId}\b"
-        compiled_pattern = re.compile(userId_key_value_pattern, re.IGNORECASE)
+        compiled_pattern = user_id_pattern(self.userId)
         for doc in relevant_docs:
-            if compiled_pattern.search(doc.page_content):
+            if (doc.metadata.get('customer_id') == self.userId 
+                or compiled_pattern.search(doc.page_content)
+            ):
                 filtered_docs.append(doc)
 
         print("FILTERED CONTENT........", filtered_docs)
 
         if filtered_docs:
-            retriever = DummyRetriever(filtered_docs=relevant_docs)
+            # Second stage filtering, keep only the closest `second_limit` documents
+            if len(filtered_docs) > self.second_limit:
+                filtered_docs = await self._re_filter_documents(filtered_docs, division)
+            retriever = DummyRetriever(filtered_docs=filtered_docs)
             return retriever
         else:
             return self.__get_fallback_retriever()
 
-    async def _retrieve_documents_parallely(self):
-        results = await asyncio.gather(
-            self._get_retriever("database"),
-            self._get_retriever("document"),
-            self._get_retriever("website")
-        )
-        return results
+    async def _embed_query(self, text:str) -> List[float]:
+        """Embeds a query once per request, off the event loop."""
+        if text not in self.query_embeddings:
+            with self.timer.stage('embed'):
+                embedding_function = await initial.RESOLVE("EMBEDDING_FUNCTION")
+                if embedding_function.batcher is not None:
+                    # Shares one embedding call with the other requests waiting right now
+                    self.query_embeddings[text] = await embedding_function.aembed_query(text)
+                else:
+                    self.query_embeddings[text] = await initial.RUN_BLOCKING(
+                        embedding_function.embed_query, text
+                    )
+        return self.query_embeddings[text]
 
-    async def _get_retriever(self, division: DIVISION_TYPE):
-        vector_store = initial.VECTOR_DB[division](initial.COLLECTION_NAME)   
+    async def _get_retriever(self, division: DIVISION_TYPE, scope_to_user:bool = True):
+        try:
+            vector_store = await initial.RUN_BLOCKING(initial.VECTOR_DB[division], self.tenant)
+        except UnknownCollection:
+            # The shop has nothing ingested in this division
+            return self.__get_fallback_retriever()
         self.first_limit = 200
         if division != 'database':
             self.first_limit = 100
@@ -230,39 +443,69 @@ class Rag:
             "lambda_mult": 0.8
         }
 
-        # filtering with tags
-        filter_tag = None
+        # filtering with tags and, for personal queries, the customer id
+        filters = []
         if division == 'database':
             if filter_tag := (await self.__filter_tags()): 
                 print("FILTER TAG................", filter_tag)
-                search_kwargs['filter'] = {'tags': filter_tag}
-            
-        retriever = vector_store.as_retriever(
-            search_type="mmr",
-            search_kwargs=search_kwargs
+                filters.append({'tags': filter_tag})
+            if scope_to_user and self.is_userId_attached and self.userId:
+                filters.append({'customer_id': self.userId})
+
+        if len(filters) == 1:
+            search_kwargs['filter'] = filters[0]
+        elif filters:
+            search_kwargs['filter'] = {'$and': filters}
+
+        # The query is embedded once per request and shared by every collection
+        embedding = await self._embed_query(self.message)
+
+        keyword_index = await self.__get_keyword_index(division)
+        if keyword_index is None:
+            return VectorRetriever(
+                vectorstore=vector_store,
+                embedding=embedding,
+                search_kwargs=search_kwargs
+            )
+
+        keyword_hits = await initial.RUN_BLOCKING(keyword_index.search, self.message, initial.KEYWORD_INDEX['top_n'])
+        print("KEYWORD HITS..........", keyword_hits)
+
+        # Exact tokens (sku, order number, product name) are found lexically, no wide MMR fan-out needed
+        personal = scope_to_user and self.is_userId_attached
+        if keyword_hits and not personal and keyword_index.has_exact_match(self.message):
+            self.first_limit = min(self.first_limit, initial.KEYWORD_INDEX['reduced_fetch_k'])
+            search_kwargs['fetch_k'] = self.first_limit
+
+        return HybridRetriever(
+            vectorstore=vector_store,
+            embedding=embedding,
+            search_kwargs=search_kwargs,
+            keyword_ids=[doc_id for doc_id, _ in keyword_hits]
         )
         
-        return retriever
-        
-    async def _re_filter_documents(self, relevant_docs:List[Document]) -> List[Document]:
+    async def _rerank_retriever(self, retriever):
+        """Sharpens the final top-k with the cross-encoder, when it is enabled."""
+        if not initial.CROSS_ENCODER['enabled']:
+            return retriever
+
+        relevant_docs = await initial.RUN_BLOCKING(retriever.invoke, self.message)
+        reranked_docs = await CrossEncoderReranker().rerank(self.message, relevant_docs)
+        return DummyRetriever(filtered_docs=reranked_docs)
+
+    async def _re_filter_documents(self, relevant_docs:List[Document], division:DIVISION_TYPE = 'database') -> List[Document]:
         # Return if empty docs
         if not relevant_docs:
             return self.empty_document
         
-        docs_without_meta:List[Document] = [
-            Document(
-                page_content=doc.page_content,
-                metadata={}
-            ) for doc in relevant_docs
-        ]
-        print("DOC WITHOUT META.......................", docs_without_meta)
-        temp_vector_store = Chroma.from_documents(docs_without_meta, initial.EMBEDDING_FUNCTION)  
-        temp_retriever = temp_vector_store.as_retriever(
-            search_type="mmr", 
-            search_kwargs= {'k':self.second_limit, "lambda_mult": 0.8},
-            persist_directory=None 
+        # Score the candidates with their stored vectors instead of re-embedding them
+        reranker = EmbeddingReranker(await initial.RUN_BLOCKING(initial.VECTOR_DB[division], self.tenant))
+        refined_results = await initial.RUN_BLOCKING(
+            reranker.rerank,
+            await self._embed_query(self.message),
+            relevant_docs,
+            self.second_limit
         )
-        refined_results = temp_retriever.invoke(self.message)
         
         # Return if empty docs
         if not refined_results:
@@ -271,17 +514,13 @@ class Rag:
         return refined_results
  
  
+    def __first_stage(self, retriever) -> List[Document]:
+        if isinstance(retriever, VectorRetriever):
+            return retriever.candidates()
+        return retriever.invoke(self.message)
+
     def __attach_userId(self) -> str:
-        
-        self_reffering_pattern = initial.USER_PATTERN['self_reffering_pattern']
-        entity_pattern = initial.USER_PATTERN['entity_pattern']
-        exclued_pattern = initial.USER_PATTERN['exclued_pattern']
-        
-        if (self.userId 
-            and re.search(self_reffering_pattern, self.message, re.IGNORECASE) 
-            and re.search(entity_pattern, self.message, re.IGNORECASE)
-            and not re.search(exclued_pattern, self.message, re.IGNORECASE)
-        ):
+        if self.userId and self.intent.is_user_scoped:
             self.message += f' and where customer/user id = {self.userId}'
             self.is_userId_attached = True
         
@@ -296,68 +535,91 @@ class Rag:
             question = self.message
             last_question = await self.memory.get_last_message()
 
-        conversation_history = await self.memory.get_conversation()
+        if self.episodic_memory:
+            # Only the past turns relevant to this question, the prompt stays the same size
+            with self.timer.stage('episodic_recall'):
+                episodes = await self.episodic_memory.recall(await self._embed_query(self.input.message))
+            conversation_history = "\n".join(episodes)
+        else:
+            conversation_history = await self.memory.get_conversation()
         self.pre_prompt_message = initial.PRE_PROMPTS['system'].format(
-            company=initial.COLLECTION_NAME,
+            company=self.tenant,
             current_question=question,
             last_question=last_question,
             history = conversation_history
         )
         return self.pre_prompt_message
 
+    async def __write_memory(self, response:str):
+        with self.timer.stage('memory'):
+            if not response:
+                return await self.memory.flush()
+
+            # Greetings only move the last message, they are not worth remembering
+            record_turn = self.intent.greeting is None
+            if record_turn and self.episodic_memory:
+                # Recalled by relevance later, so it is never summarized
+                await self.episodic_memory.add(
+                    f"User: {self.input.message} | Bot: {response}",
+                    await self._embed_query(self.input.message)
+                )
+                record_turn = False
+            await self.memory.add_memory(self.message, response, record_turn=record_turn)
+
+    async def __faq_handler(self) -> Optional[str]:
+        if not initial.FAQ_INDEX['enabled'] or self.intent.is_user_scoped:
+            return None
+        faq_index = FaqIndex.current(self.tenant)
+        if faq_index is None:
+            return None
+
+        with self.timer.stage('faq'):
+            matched = faq_index.match(self.input.message)
+            if matched is None:
+                return None
+
+            position, score = matched
+            query_embedding = None
+            if score >= initial.FAQ_INDEX['direct_score'] and faq_index.embeddings is not None:
+                query_embedding = await self._embed_query(self.input.message)
+
+            if not faq_index.is_confident(position, score, query_embedding):
+                # Near miss, the normal pipeline answers it
+                print("FAQ NEAR MISS..........", faq_index.questions[position], score)
+                return None
+
+        print("FAQ HIT..........", faq_index.questions[position], score)
+        await self.memory.add_division(initial.DIVISIONS['doc'])
+        return faq_index.answers[position]
+
     def __greeting_handler(self) -> Optional[str]:
-        greeting_pattern = initial.GREETING_PATTERNS['greeting_pattern']
-        strict_gretting_pattern = initial.GREETING_PATTERNS['strict_gretting_pattern']
-        
         response = None
-        if (re.search(greeting_pattern, self.message)
-            or re.search(strict_gretting_pattern, self.message)
-        ):
+        if self.intent.greeting == 'greeting':
             response = "👋 Hello! How can I help you today? 😊"
-        elif 'nice to meet you' in self.message:
+        elif self.intent.greeting == 'nice_to_meet_you':
             response = "🙂 Nice to meet you too! 👋 How can I assist you today? 🤔"
-        elif 'how are you' in self.message:
+        elif self.intent.greeting == 'how_are_you':
             response = "I'm good, thanks! 👍 Ready to help 😊"
 
-        if response:
-            asyncio.create_task(self.memory.add_memory(self.message, response))
-            
         return response
 
     async def __filter_tags(self) -> Optional[str]:
-        cart_pattern = initial.FILTER_TAG_PATTERNS['cart_pattern']
-        order_pattern = initial.FILTER_TAG_PATTERNS['order_pattern']
-        product_pattern = initial.FILTER_TAG_PATTERNS['product_pattern']
-        post_pattern = initial.FILTER_TAG_PATTERNS['post_pattern']
-        helper_category_pattern = initial.FILTER_TAG_PATTERNS['helper_category_pattern']
-        excluding_category_pattern = initial.FILTER_TAG_PATTERNS['excluding_category_pattern']
-        
+        # Resolved once per request, later calls reuse it
+        if self.filter_tag_resolved:
+            return self.filter_tag
+        self.filter_tag_resolved = True
+
         tag = None
         # if its a follow up question just return previous filter tag
         if self.is_followUp:
             if tag := await self.memory.get_last_filter_tag():
-                return tag or None
-
-        # Check for category-based tags first to avoid conflicts
-        if (
-            helper_category_pattern.search(self.input.message) 
-            and not excluding_category_pattern.search(self.input.message)
-        ):
-            if product_pattern.search(self.input.message):
-                tag = 'product_category_tag'
-            elif post_pattern.search(self.input.message):
-                tag = 'post_category_tag'
-
-        # Check for other individual tags
-        if tag is None:
-            if cart_pattern.search(self.input.message):
-                tag = 'cart_tag'
-            elif product_pattern.search(self.input.message):
-                tag = 'product_tag'
-            elif order_pattern.search(self.input.message):
-                tag = 'order_tag'
-            elif post_pattern.search(self.input.message):
-                tag = 'post_tag'
+                self.filter_tag = tag
+                return tag
+
+        # Tags detected by the intent scanner, else the one suggested by the routing call
+        tag = self.intent.filter_tag
+        if tag is None and self.routing is not None:
+            tag = self.routing.filter_tag
         
         if tag:
             await self.memory.add_filter_tag(tag)
@@ -365,36 +627,82 @@ class Rag:
         self.filter_tag = tag
         return tag
     
-    async def __find_division_type(self) -> DIVISION_TYPE:
-        prompt = initial.PRE_PROMPTS['division'].format(
-            user_query = self.message,
+    async def __route_query(self) -> RoutingDecision:
+        """Detects follow up, division and filter tag, with at most one llm call."""
+        last_message = await self.memory.get_last_message()
+        with self.timer.stage('division'):
+            local_division = await self.__classify_division_locally()
+
+        # Nothing to follow up on and the division is clear, no llm call needed
+        if local_division and not last_message:
+            return RoutingDecision(division=local_division)
+
+        # When the division is already known only the small follow up prompt is sent
+        prompt = initial.PRE_PROMPTS['followUp' if local_division else 'routing'].format(
+            prev_query = last_message,
+            current_query = self.input.message
         )
 
-        llm = initial.MODELS['vision']
-        response:Any = llm.invoke(input=prompt)
+        try:
+            llm:BaseChatModel = await initial.RESOLVE("MODELS.vision")
+            with self.timer.stage('follow_up'):
+                response:Any = await llm.ainvoke(input=prompt)
+            print("ROUTING CONTENT.........................", response.content)
+            decision = self._parse_routing_response(response.content, has_last_message=bool(last_message))
+        except Exception:
+            traceback.print_exc()
+            decision = self._parse_routing_response("", has_last_message=bool(last_message))
 
-        content = response.content
-        if any(division for division in ['website', 'database', 'document'] if division in content):
-            return content
-        
-        return 'database'
+        if local_division:
+            decision.division = local_division
+        return decision
 
-    async def __detect_follow_up_query(self) -> bool:
-        """Detects if the current query is a follow-up query."""
-        # return any(pattern.search(self.input.message) for pattern in initial.FOLLOW_UP_PATTERN)
-        
-        prompt = initial.PRE_PROMPTS['followUp'].format(
-            prev_query = await self.memory.get_last_message(),
-            current_query = self.input.message
-        )
+    async def __classify_division_locally(self) -> Optional[DIVISION_TYPE]:
+        if not initial.DIVISION_CLASSIFIER['enabled']:
+            return None
+
+        # Checks the centroid file's mtime and reloads it after an ingestion run, file io
+        classifier = await initial.RUN_BLOCKING(DivisionClassifier.load, self.tenant)
+        if classifier is None:
+            return None
 
-        llm:BaseChatModel =  initial.MODELS['vision']
-        response:Any = llm.invoke(input=prompt)
-        print("DETECT FOLLOW UP......................", self.input.message, await self.memory.get_last_message())
-        print("FOLLOW UP CONTENT.........................", response.content)
-        answer = response.content.lower()
-        is_follow_up = "yes" in answer
-        return is_follow_up
+        division, margin = classifier.classify(await self._embed_query(self.input.message))
+        print("LOCAL DIVISION..................", division, round(margin, 4))
+        return division
+
+    def _parse_routing_response(self, content:str, has_last_message:bool = True) -> RoutingDecision:
+        """Parses the routing json, falling back to regex when the llm output is malformed."""
+        decision = None
+        if json_match := re.search(r'\{.*\}', content or "", re.DOTALL):
+            try:
+                data = json.loads(json_match.group())
+                if data.get('filter_tag') not in initial.FILTER_TAGS:
+                    data['filter_tag'] = None
+                decision = RoutingDecision(**data)
+            except Exception:
+                decision = None
+
+        if decision is None:
+            # Regex fallback for partial or non json responses
+            answer = (content or "").lower()
+            follow_up_match = re.search(r'is_follow_up\W*(true|false|yes|no)', answer)
+            if follow_up_match:
+                is_follow_up = follow_up_match.group(1) in ('true', 'yes')
+            else:
+                is_follow_up = any(pattern.search(self.input.message) for pattern in initial.FOLLOW_UP_PATTERN)
+
+            division_match = re.search(r'\b(database|document|website)\b', answer)
+            tag_match = re.search(r'\b(' + '|'.join(initial.FILTER_TAGS) + r')\b', answer)
+            decision = RoutingDecision(
+                is_follow_up = is_follow_up,
+                division = division_match.group(1) if division_match else 'database',
+                filter_tag = tag_match.group(1) if tag_match else None
+            )
+
+        # there is nothing to follow without a previous message
+        if not has_last_message:
+            decision.is_follow_up = False
+        return decision
         
     def __limit_setter(self, level: Literal['first', 'second'], set_limit: int):
         setattr(self, f"{level}_limit", set_limit)
@@ -409,14 +717,39 @@ class Rag:
         else:
             self.second_limit = 10
     
+    async def __get_keyword_index(self, division:DIVISION_TYPE) -> Optional[KeywordIndex]:
+        if not initial.KEYWORD_INDEX['enabled']:
+            return None
+        try:
+            # Reading the metadata and mapping the postings is file io, kept off the event loop
+            return await initial.RUN_BLOCKING(KeywordIndex.load, self.tenant, division)
+        except Exception as e:
+            print(f"Keyword index unavailable for '{division}' - {e}")
+            return None
+
+    def __is_shareable(self) -> bool:
+        # Personal, cart and follow up answers depend on more than the query itself
+        if self.routing is None or self.intent.is_user_scoped or self.is_followUp:
+            return False
+        return not (self.routing.filter_tag == 'cart_tag' or self.intent.is_cart)
+
+    def __get_semantic_cache(self) -> Optional[SemanticCache]:
+        if not initial.SEMANTIC_CACHE['enabled'] or not self.__is_shareable():
+            return None
+        return SemanticCache(self.tenant, self.routing.division)
+
+    async def __get_single_flight(self) -> Optional[SingleFlight]:
+        if not initial.SINGLE_FLIGHT['enabled'] or not self.__is_shareable():
+            return None
+        version = await initial.GET_COLLECTION_VERSION(self.tenant)
+        return SingleFlight(self.input.message, self.tenant, version, self.routing.division)
+
+    async def __record_shared_routing(self):
+        # Waiters never run the retriever, keep their memory as if they had
+        await self.memory.add_division(self.routing.division)
+        if self.routing.division == 'database':
+            await self.__filter_tags()
+
     def __get_fallback_retriever(self) -> DummyRetriever:
         retriever = DummyRetriever(filtered_docs = self.empty_document)
         return retriever
-
-    def _stream(self, response:str):
-        async def generator_func(_: dict) -> AsyncIterator[str]:
-            parts = re.findall(r'\S+|\s+', response)
-            for part in parts:
-                await asyncio.sleep(0.1)  # smoother experience
-                yield part
-        return RunnableLambda(generator_func)
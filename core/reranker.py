@@ -0,0 +1,37 @@
+from typing import List
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from core.vectors import normalize, normalize_rows
+
+
+class EmbeddingReranker:
+
+    def __init__(self, vectorstore:Chroma):
+        """Re-ranks candidates with the embeddings already stored in their source collection."""
+        self.vectorstore = vectorstore
+
+    def rerank(self, query_embedding:List[float], documents:List[Document], top_k:int) -> List[Document]:
+        """Returns the `top_k` documents closest to the query, scored with one matrix multiply."""
+        ids = [doc.id for doc in documents if doc.id]
+        if not ids:
+            return documents[:top_k]
+
+        stored = self.vectorstore._collection.get(ids=ids, include=['embeddings'])
+        vectors = dict(zip(stored['ids'], stored['embeddings']))
+
+        scored_docs = [doc for doc in documents if doc.id in vectors]
+        unscored_docs = [doc for doc in documents if doc.id not in vectors]
+        if not scored_docs:
+            return documents[:top_k]
+
+        matrix = normalize_rows(np.asarray([vectors[doc.id] for doc in scored_docs], dtype=np.float32))
+        scores = matrix @ normalize(query_embedding)
+
+        # Partial selection of the best candidates, only those get sorted
+        limit = min(top_k, len(scored_docs))
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+
+        # Candidates without a stored vector keep their retrieval order at the end
+        return ([scored_docs[index] for index in best] + unscored_docs)[:top_k]
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from core.vectors import decode_vector, encode_vector, normalize
+import initial
+
+
+@dataclass
+class _ScopeMatrix:
+    """In-process copy of one scope's normalised query vectors, rows in `fields` order."""
+    scope: str
+    generation: int
+    fields: List[str]
+    vectors: np.ndarray
+    created: np.ndarray
+
+    def best(self, query:np.ndarray, min_created:float) -> Tuple[Optional[str], float]:
+        if not self.fields:
+            return None, 0.0
+        similarities = self.vectors @ query
+        similarities[self.created < min_created] = -np.inf
+        best = int(np.argmax(similarities))
+        return self.fields[best], float(similarities[best])
+
+
+class SemanticCache:
+
+    # (collection, division) -> vectors of the current version, refreshed when the scope's generation moves
+    _matrices:Dict[Tuple[str, str], _ScopeMatrix] = {}
+
+    def __init__(self, collection_name:str, division:str):
+        """
+            Semantic answer cache scoped per collection and division.
+            Query vectors, answers and insertion times are separate redis keys, so a lookup
+            scores an in-process matrix and fetches only the winning answer.
+        """
+        self.collection_name = collection_name
+        self.division = division
+
+        self.redis_client = initial.REDIS_CLIENT
+        self.threshold:float = initial.SEMANTIC_CACHE['threshold']
+        self.ttl:int = initial.SEMANTIC_CACHE['ttl']
+        self.max_entries:int = initial.SEMANTIC_CACHE['max_entries']
+
+    async def lookup(self, embedding:List[float]) -> Optional[str]:
+        """Return the stored answer of the closest cached query above the threshold."""
+        scope = await self.__scope_key()
+        matrix = await self.__current_matrix(scope)
+        if not matrix.fields:
+            return None
+
+        field, score = await initial.RUN_BLOCKING(
+            matrix.best, normalize(embedding), time.time() - self.ttl
+        )
+        print("SEMANTIC CACHE SCORE................", score)
+        if field is None or score < self.threshold:
+            return None
+
+        raw_entry = await self.redis_client.hget(f"{scope}:answers", field)
+        return json.loads(raw_entry)['answer'] if raw_entry else None
+
+    async def add(self, query:str, embedding:List[float], answer:str):
+        """Store an answer against the query embedding."""
+        scope = await self.__scope_key()
+        field = self.__query_hash(query)
+        created = time.time()
+
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(f"{scope}:vectors", field, encode_vector(normalize(embedding)))
+            pipe.hset(f"{scope}:answers", field, json.dumps({"query": query, "answer": answer}))
+            pipe.zadd(f"{scope}:created", {field: created})
+            pipe.incr(f"{scope}:generation")
+            for suffix in ("vectors", "answers", "created", "generation"):
+                pipe.expire(f"{scope}:{suffix}", self.ttl)
+            pipe.zcard(f"{scope}:created")
+            results = await pipe.execute()
+        size = results[-1]
+
+        # Keep the scope bounded, expired and then the oldest entries go first
+        stale = await self.redis_client.zrangebyscore(f"{scope}:created", "-inf", created - self.ttl)
+        if (overflow := size - len(stale) - self.max_entries) > 0:
+            # Ascending by insertion time, so the expired entries lead this range
+            stale = await self.redis_client.zrange(f"{scope}:created", 0, len(stale) + overflow - 1)
+        if stale:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.zrem(f"{scope}:created", *stale)
+                pipe.hdel(f"{scope}:vectors", *stale)
+                pipe.hdel(f"{scope}:answers", *stale)
+                pipe.incr(f"{scope}:generation")
+                await pipe.execute()
+
+    @classmethod
+    async def invalidate(cls, collection_name:str):
+        """Remove every cached answer of a collection, regardless of version."""
+        keys = [key async for key in initial.REDIS_CLIENT.scan_iter(f"semantic_cache:{collection_name}:*")]
+        if keys:
+            await initial.REDIS_CLIENT.delete(*keys)
+        for scope in [scope for scope in cls._matrices if scope[0] == collection_name]:
+            cls._matrices.pop(scope, None)
+
+    async def __current_matrix(self, scope:str) -> _ScopeMatrix:
+        """The local matrix, synced with redis only when another add or eviction happened."""
+        generation = int(await self.redis_client.get(f"{scope}:generation") or 0)
+        matrix = self._matrices.get((self.collection_name, self.division))
+        if matrix is not None and matrix.scope == scope and matrix.generation == generation:
+            return matrix
+
+        entries = await self.redis_client.zrange(f"{scope}:created", 0, -1, withscores=True)
+        known:Dict[str, np.ndarray] = {}
+        if matrix is not None and matrix.scope == scope:
+            known = dict(zip(matrix.fields, matrix.vectors))
+
+        # Only vectors this worker has not seen yet cross the wire
+        missing = [field for field, _ in entries if field not in known]
+        if missing:
+            encoded = await self.redis_client.hmget(f"{scope}:vectors", missing)
+            known |= {field: raw for field, raw in zip(missing, encoded) if raw}
+
+        matrix = await initial.RUN_BLOCKING(self.__build_matrix, scope, generation, entries, known)
+        self._matrices[(self.collection_name, self.division)] = matrix
+        return matrix
+
+    def __build_matrix(self, scope:str, generation:int, entries:List[Tuple[str, float]], known:Dict) -> _ScopeMatrix:
+        fields, vectors, created = [], [], []
+        for field, timestamp in entries:
+            if (vector := known.get(field)) is None:
+                continue
+            fields.append(field)
+            vectors.append(decode_vector(vector) if isinstance(vector, str) else vector)
+            created.append(timestamp)
+        return _ScopeMatrix(
+            scope=scope,
+            generation=generation,
+            fields=fields,
+            vectors=np.vstack(vectors) if vectors else np.empty((0, 0), dtype=np.float32),
+            created=np.asarray(created, dtype=np.float64)
+        )
+
+    async def __scope_key(self) -> str:
+        # Version is part of the key, so an ingestion run makes old entries unreachable
+        version = await initial.GET_COLLECTION_VERSION(self.collection_name)
+        return f"semantic_cache:{self.collection_name}:v{version}:{self.division}"
+
+    def __query_hash(self, query:str) -> str:
+        normalized = re.sub(r'\s+', ' ', query.strip().lower())
+        return hashlib.sha1(normalized.encode()).hexdigest()
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import json
+import re
+import uuid
+from typing import AsyncIterator, Callable, Dict, List, Optional
+import initial
+
+WORKER_ID = uuid.uuid4().hex
+
+
+def normalize_query(query:str) -> str:
+    """Lowercase, single spaced and without trailing punctuation, so trivial variants coalesce."""
+    return re.sub(r"\s+", " ", query.lower()).strip(" ?!.,")
+
+
+class _Flight:
+    """Tokens of one in-flight answer, replayed to every waiter from the start."""
+
+    def __init__(self):
+        self.tokens:List[str] = []
+        self.done:bool = False
+        self.error:Optional[BaseException] = None
+        self.waiters:int = 0
+        self.changed = asyncio.Event()
+        self.task:Optional[asyncio.Task] = None
+
+    def push(self, token:str):
+        self.tokens.append(token)
+        self.__notify()
+
+    def finish(self, error:Optional[BaseException] = None):
+        self.done, self.error = True, error
+        self.__notify()
+
+    async def follow(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.tokens):
+                yield self.tokens[index]
+                index += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await self.changed.wait()
+
+    def __notify(self):
+        # Wake the current waiters, later ones wait on a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    """
+        Coalesces identical concurrent questions into one pipeline run.
+        Inside a process the waiters share the tokens in memory, across workers
+        the leader holds a redis lock and publishes its tokens on a channel.
+    """
+
+    _flights:Dict[str, _Flight] = {}
+
+    def __init__(self, query:str, collection_name:str, version:int, division:str):
+        self.config = initial.SINGLE_FLIGHT
+        self.redis_client = initial.REDIS_CLIENT
+        digest = hashlib.sha1(normalize_query(query).encode()).hexdigest()
+        self.key = f"single_flight:{collection_name}:v{version}:{division}:{digest}"
+
+    async def stream(self, producer:Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Yields the answer of the in-flight run for this key, starting one with `producer` if needed."""
+        flight = self._flights.get(self.key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[self.key] = flight
+            # The run is not tied to the first caller, it finishes even if that client leaves
+            flight.task = asyncio.create_task(self.__lead(flight, producer))
+        else:
+            print(f"SINGLE FLIGHT JOINED.......... {self.key} ({flight.waiters + 1} waiting)")
+
+        flight.waiters += 1
+        try:
+            async for token in flight.follow():
+                yield token
+        finally:
+            flight.waiters -= 1
+
+    async def __lead(self, flight:_Flight, producer:Callable[[], AsyncIterator[str]]):
+        try:
+            if self.config['distributed']:
+                source = await self.__distributed(producer)
+            else:
+                source = producer()
+            async for token in source:
+                flight.push(token)
+            flight.finish()
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            if self._flights.get(self.key) is flight:
+                del self._flights[self.key]
+
+    async def __distributed(self, producer:Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        acquired = await self.redis_client.set(
+            f"{self.key}:lock", WORKER_ID, nx=True, px=self.config['lock_ttl_ms']
+        )
+        if acquired:
+            # Drop the backlog of a previous run of the same question
+            await self.redis_client.delete(f"{self.key}:tokens")
+            return self.__publish(producer())
+        return self.__subscribe(producer)
+
+    async def __publish(self, source:AsyncIterator[str]) -> AsyncIterator[str]:
+        """Runs the pipeline here and mirrors every token to the other workers."""
+        index = 0
+        try:
+            async for token in source:
+                await self.__send({"i": index, "token": token})
+                index += 1
+                yield token
+            await self.__send({"i": index, "done": True})
+        except Exception:
+            await self.__send({"i": index, "error": True})
+            raise
+        finally:
+            await self.redis_client.expire(f"{self.key}:tokens", self.config['backlog_ttl'])
+            await self.redis_client.delete(f"{self.key}:lock")
+
+    async def __send(self, message:Dict):
+        payload = json.dumps(message)
+        # The list is the backlog for workers subscribing after the first tokens
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(f"{self.key}:tokens", payload)
+            pipe.publish(f"{self.key}:channel", payload)
+            await pipe.execute()
+
+    async def __subscribe(self, producer:Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Streams the tokens another worker is producing, or answers locally if it goes quiet."""
+        pubsub = self.redis_client.pubsub()
+        await pubsub.subscribe(f"{self.key}:channel")
+        try:
+            next_index = 0
+            # Subscribed before reading the backlog, so no token falls in between
+            pending = await self.redis_client.lrange(f"{self.key}:tokens", 0, -1)
+            while True:
+                for payload in pending:
+                    message = json.loads(payload)
+                    if message['i'] < next_index:
+                        continue
+                    if message['i'] > next_index:
+                        # A gap, the backlog has everything published so far
+                        pending = await self.redis_client.lrange(f"{self.key}:tokens", next_index, -1)
+                        break
+                    if message.get('error'):
+                        raise RuntimeError(f"Single flight leader failed for {self.key}")
+                    if message.get('done'):
+                        return
+                    next_index += 1
+                    yield message['token']
+                else:
+                    received = await self.__next_message(pubsub)
+                    if received is None:
+                        if next_index:
+                            raise TimeoutError(f"Single flight leader stalled for {self.key}")
+                        print(f"SINGLE FLIGHT TIMEOUT.......... answering {self.key} locally")
+                        async for token in producer():
+                            yield token
+                        return
+                    pending = [received['data']]
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+    async def __next_message(self, pubsub) -> Optional[Dict]:
+        # Subscribe confirmations also come back as None, so wait against a deadline
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.config['wait_timeout']
+        while (remaining := deadline - loop.time()) > 0:
+            received = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if received is not None:
+                return received
+        return None
@@ -0,0 +1,94 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+import initial
+
+
+class StageTimer:
+    """Monotonic per-stage durations of one request, repeated stages add up."""
+
+    def __init__(self, session_id:Optional[str] = None):
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.started_at = time.perf_counter()
+        self.stages:Dict[str, float] = {}  # name -> seconds
+
+    @contextmanager
+    def stage(self, name:str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name:str, seconds:float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def mark(self, name:str):
+        """Records the time elapsed since the request started, e.g. time to first token."""
+        self.stages[name] = time.perf_counter() - self.started_at
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={milliseconds}" for name, milliseconds in self.as_dict().items())
+
+
+class TimingLog:
+    """Ring buffer of the latest request breakdowns, for the admin debug endpoint."""
+
+    _timers:Deque[StageTimer] = deque(maxlen=initial.TIMING['history_size'])
+
+    @classmethod
+    def add(cls, timer:StageTimer):
+        cls._timers.append(timer)
+
+    @classmethod
+    def recent(cls, limit:int) -> List[Dict[str, Any]]:
+        # Timers are stored by reference, late stages like the memory write show up once done
+        return [
+            {
+                "session_id": timer.session_id,
+                "created_at": timer.created_at,
+                "stages_ms": timer.as_dict()
+            }
+            for timer in list(cls._timers)[-limit:][::-1]
+        ]
+
+
+class ServerTimingStreamingResponse(StreamingResponse):
+    """
+        Streaming response that repeats the `Server-Timing` header as an HTTP trailer
+        once the body is done, on ASGI servers announcing `http.response.trailers`.
+    """
+
+    def __init__(self, *args, server_timing:Callable[[], str], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server_timing = server_timing
+        self.send_trailers = False
+
+    async def __call__(self, scope:Scope, receive:Receive, send:Send) -> None:
+        self.send_trailers = "http.response.trailers" in scope.get("extensions", {})
+        if self.send_trailers:
+            self.headers["Trailer"] = "Server-Timing"
+        await super().__call__(scope, receive, send)
+
+    async def stream_response(self, send:Send) -> None:
+        if not self.send_trailers:
+            return await super().stream_response(send)
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers, "trailers": True})
+        async for chunk in self.body_iterator:
+            if not isinstance(chunk, (bytes, memoryview)):
+                chunk = chunk.encode(self.charset)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        await send({
+            "type": "http.response.trailers",
+            "headers": [(b"server-timing", self.server_timing().encode("latin-1"))],
+            "more_trailers": False
+        })
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Set, Tuple
+import chromadb
+from chromadb.config import Settings
+from chromadb.errors import InvalidCollectionException
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+
+
+class UnknownCollection(KeyError):
+    """The tenant has no collection in this division, only ingestion creates one."""
+
+
+class VectorStoreRegistry:
+
+    def __init__(
+        self,
+        directories:Dict[str, str],
+        embedding_function:Embeddings,
+        max_open:int,
+        idle_seconds:float,
+        memory_limit_bytes:int = 0
+    ):
+        """
+            Hands out one `Chroma` handle per (tenant, division), bound to its own collection
+            and never re-pointed afterwards. One persistent client is shared per division
+            directory, and at most `max_open` handles stay open, least recently used first out.
+
+            Dropping a handle does not unload the collection's HNSW index from chromadb,
+            `memory_limit_bytes` is what bounds the loaded indexes, with chromadb's LRU segment cache.
+        """
+        self.directories = directories
+        self.embedding_function = embedding_function
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.memory_limit_bytes = memory_limit_bytes
+
+        self._clients:Dict[str, chromadb.ClientAPI] = {}
+        self._handles:"OrderedDict[Tuple[str, str], Tuple[Chroma, float]]" = OrderedDict()
+        self._known_tenants:Set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self, tenant:str, division:str, create:bool = False) -> Chroma:
+        """
+            The tenant's collection in `division`. Requests only read existing collections,
+            `create` is for ingestion, otherwise an unknown one raises `UnknownCollection`.
+        """
+        key = (tenant, division)
+        with self._lock:
+            now = time.monotonic()
+            self.__evict_idle(now)
+
+            if key in self._handles:
+                vectorstore, _ = self._handles.pop(key)
+            else:
+                try:
+                    vectorstore = Chroma(
+                        client=self.__client(division),
+                        collection_name=tenant,
+                        embedding_function=self.embedding_function,
+                        collection_metadata={"hnsw:space": "cosine"},
+                        create_collection_if_not_exists=create
+                    )
+                except InvalidCollectionException:
+                    raise UnknownCollection(key)
+                self._known_tenants.add(tenant)
+
+            # Most recently used at the end, the front is evicted first
+            self._handles[key] = (vectorstore, now)
+            while len(self._handles) > self.max_open:
+                self._handles.popitem(last=False)
+            return vectorstore
+
+    def has_tenant(self, tenant:str) -> bool:
+        """Whether any division has a collection for `tenant`, blocking on the first check of a tenant."""
+        with self._lock:
+            if tenant in self._known_tenants:
+                return True
+            for division in self.directories:
+                try:
+                    self.__client(division).get_collection(tenant)
+                except (InvalidCollectionException, ValueError):
+                    continue
+                self._known_tenants.add(tenant)
+                return True
+            return False
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"open": len(self._handles), "max_open": self.max_open, "memory_limit_bytes": self.memory_limit_bytes}
+
+    def __client(self, division:str) -> chromadb.ClientAPI:
+        if division not in self._clients:
+            settings = Settings(anonymized_telemetry=False)
+            if self.memory_limit_bytes:
+                # Least recently used collection indexes are unloaded past the limit
+                settings = Settings(
+                    anonymized_telemetry=False,
+                    chroma_segment_cache_policy="LRU",
+                    chroma_memory_limit_bytes=self.memory_limit_bytes
+                )
+            self._clients[division] = chromadb.PersistentClient(path=self.directories[division], settings=settings)
+        return self._clients[division]
+
+    def __evict_idle(self, now:float):
+        while self._handles:
+            _, (_, last_used) = next(iter(self._handles.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            self._handles.popitem(last=False)
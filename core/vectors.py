@@ -0,0 +1,26 @@
+import base64
+from typing import List, Union
+import numpy as np
+
+Vector = Union[List[float], np.ndarray]
+
+
+def normalize(embedding:Vector) -> np.ndarray:
+    """Unit length float32 copy of one embedding, a zero vector stays zero."""
+    return normalize_rows(np.asarray(embedding, dtype=np.float32))
+
+
+def normalize_rows(matrix:np.ndarray) -> np.ndarray:
+    """Every row (the last axis) scaled to unit length, so dot products are cosine similarities."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def encode_vector(embedding:Vector) -> str:
+    """Compact redis representation, base64 of the float32 bytes."""
+    return base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()).decode()
+
+
+def decode_vector(encoded:str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float32)
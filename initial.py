@@ -1,25 +1,95 @@
+import asyncio
 import json
 import os
 import re
-from typing import Any, Callable, Dict, List, Literal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Literal
 from dotenv import load_dotenv
-import redis.asyncio as redis
-import spacy
-from langchain.chat_models import init_chat_model
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_core.language_models import BaseChatModel
+from core.background import BackgroundTaskRunner
+from core.intent import IntentScanner
+from core.lazy import LazyMapping, LazyResources
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+    from langchain_core.language_models import BaseChatModel
 
 
 # ** THIRD PARTY RELATED INITIALS **
 # Load API Key from Environment Variable
 load_dotenv()
 
+# Clients and models are created on first use instead of at import, see `__getattr__` below
+_LAZY = LazyResources(globals())
+RESOURCE_INIT_TIMES = _LAZY.init_times
+
+def __getattr__(name:str) -> Any:
+    """Module level lookups of a lazy resource (`initial.REDIS_CLIENT`) create it on first access."""
+    return _LAZY.get(name)
+
+def IS_INITIALISED(name:str) -> bool:
+    return name in globals()
+
+# Resources to create at startup instead of on the first request, a comma separated list, "all" or "none".
+# The default covers everything a chat request touches, so no request pays for a model load
+WARM_UP_RESOURCES: List[str] = [
+    name.strip() for name in os.getenv(
+        "WARM_UP_RESOURCES",
+        "REDIS_CLIENT,TOKENIZER_MODEL,EMBEDDING_FUNCTION,VECTOR_REGISTRY,MODELS.vision,MODELS.small"
+    ).split(",") if name.strip() and name.strip() != "none"
+]
+
+async def WARM_UP(*names:str):
+    """Create the given resources (all of them by default) on the executor, off the event loop."""
+    for name in names or _LAZY.names:
+        if name.startswith("MODELS."):
+            await RUN_BLOCKING(MODELS.__getitem__, name.removeprefix("MODELS."))
+        else:
+            await RUN_BLOCKING(_LAZY.get, name)
+
+async def RESOLVE(name:str) -> Any:
+    """
+        A lazy resource (or "MODELS.<name>") for async code. One that is not created yet
+        is built on the executor, so the event loop never blocks on a model load or its lock.
+    """
+    if name.startswith("MODELS."):
+        model = name.removeprefix("MODELS.")
+        return MODELS[model] if MODELS.is_created(model) else await RUN_BLOCKING(MODELS.__getitem__, model)
+    return globals()[name] if IS_INITIALISED(name) else await RUN_BLOCKING(_LAZY.get, name)
+
 # Redis client setup
-REDIS_CLIENT = redis.Redis(host="localhost", port=6379, decode_responses=True)
+@_LAZY.register("REDIS_CLIENT")
+def _create_redis_client():
+    import redis.asyncio as redis
+    return redis.Redis(host="localhost", port=6379, decode_responses=True)
 
 # Intializin Natural language processor
-NLP_PROCESSOR = spacy.load("en_core_web_sm")
+@_LAZY.register("NLP_PROCESSOR")
+def _create_nlp_processor():
+    import spacy
+    return spacy.load("en_core_web_sm")
+
+
+
+# ** CONCURRENCY RELATED INITIALS **
+# Bounded pool for CPU bound work (embedding, mmr, re-ranking) so it never runs on the event loop
+CPU_EXECUTOR_WORKERS = int(os.getenv("CPU_EXECUTOR_WORKERS", 4))
+CPU_EXECUTOR = ThreadPoolExecutor(
+    max_workers=CPU_EXECUTOR_WORKERS,
+    thread_name_prefix="rag-cpu"
+)
+
+async def RUN_BLOCKING(func:Callable, *args, **kwargs) -> Any:
+    """Run a blocking function on the bounded cpu executor and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CPU_EXECUTOR, partial(func, *args, **kwargs))
+
+# Post-response work (memory writes, summaries) runs here, bounded and drained on shutdown
+BACKGROUND_TASKS = BackgroundTaskRunner(
+    max_concurrency=int(os.getenv("BACKGROUND_TASKS_MAX_CONCURRENCY", 4)),
+    max_queue=int(os.getenv("BACKGROUND_TASKS_MAX_QUEUE", 500))
+)
+BACKGROUND_TASKS_DRAIN_TIMEOUT = float(os.getenv("BACKGROUND_TASKS_DRAIN_TIMEOUT", 20))  # seconds
 
 
 
@@ -39,23 +109,49 @@ MODEL_NAMES : Dict[
 # Initialize the chat model
 def initialise_model(model:Literal[
     'vision','specdec',"versatile", "small"
-]) ->BaseChatModel:
+]) -> "BaseChatModel":
+    from langchain.chat_models import init_chat_model
     return init_chat_model(
         MODEL_NAMES[model],
         model_provider="groq",
         api_key=GROQ_API_KEY,
     )
 
+# Each model is initialised the first time it is looked up
 MODELS : Dict[
     Literal['vision','specdec',"versatile", "small"], 
-    BaseChatModel
-] = {
-    "vision" : initialise_model('vision'),
-    "specdec" : initialise_model('specdec'),
-    "versatile" : initialise_model('versatile'),
-    "small": initialise_model('small')
+    "BaseChatModel"
+] = LazyMapping(
+    {model: partial(initialise_model, model) for model in MODEL_NAMES},
+    init_times=RESOURCE_INIT_TIMES,
+    prefix="MODELS"
+)
+
+# Token counts for the context and memory budgets. `get_num_tokens` of the groq models falls back
+# to a GPT-2 tokenizer from transformers, so the llama tokenizer.json is read directly when given
+TOKENIZER: Dict[Literal['file', 'chars_per_token'], Any] = {
+    "file": os.getenv("TOKENIZER_FILE", ""),
+    "chars_per_token": 4,  # estimate used without a tokenizer file
 }
 
+@_LAZY.register("TOKENIZER_MODEL")
+def _create_tokenizer_model():
+    if not TOKENIZER['file']:
+        return None
+    try:
+        from tokenizers import Tokenizer
+        return Tokenizer.from_file(TOKENIZER['file'])
+    except Exception as e:
+        print(f"Tokenizer unavailable, estimating tokens - {e}")
+        return None
+
+def COUNT_TOKENS(text:str) -> int:
+    """Tokens in `text` for the chat models, blocking on first use while the tokenizer loads."""
+    tokenizer = _LAZY.get("TOKENIZER_MODEL")
+    if tokenizer is None:
+        return -(-len(text) // TOKENIZER['chars_per_token'])
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
 
 
 # ** EMBEDDING FUNCTION RELATED INITIALS **
@@ -70,41 +166,125 @@ encode_kwargs = {
     "normalize_embeddings": True,  # Normalize for better cosine similarity search
 }
 
-EMBEDDING_FUNCTION = HuggingFaceEmbeddings(
-    model_name=model_name,
-    model_kwargs=model_kwargs,
-    encode_kwargs=encode_kwargs
-)
-EMBEDDING_FUNCTION.show_progress = True
+# Query embedding cache, optionally shared across workers through redis
+EMBEDDING_CACHE: Dict[
+    Literal['max_size', 'redis_backed', 'redis_ttl'], Any
+] = {
+    "max_size": int(os.getenv("EMBEDDING_CACHE_SIZE", 2048)),
+    "redis_backed": os.getenv("EMBEDDING_CACHE_REDIS", "false").lower() == "true",
+    "redis_ttl": int(os.getenv("EMBEDDING_CACHE_TTL", 86400))
+}
+
+# Query embeddings that miss the cache are embedded together with the ones arriving at the same moment
+EMBEDDING_BATCH: Dict[
+    Literal['enabled', 'max_batch_size', 'max_wait_ms'], Any
+] = {
+    "enabled": os.getenv("EMBEDDING_BATCH_ENABLED", "true").lower() == "true",
+    "max_batch_size": int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", 8)),
+    "max_wait_ms": float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", 5)),
+}
+
+# Backend running the embedding model, "torch" (sentence-transformers) or "onnx" (int8 quantized export)
+# Export the onnx model once with `./run onnx`
+EMBEDDING_BACKEND: Dict[
+    Literal['backend', 'onnx_directory', 'onnx_file', 'onnx_threads'], Any
+] = {
+    "backend": os.getenv("EMBEDDING_BACKEND", "torch").lower(),
+    "onnx_directory": os.getenv("EMBEDDING_ONNX_DIRECTORY", "models/all-mpnet-base-v2-onnx"),
+    "onnx_file": os.getenv("EMBEDDING_ONNX_FILE", "model_quantized.onnx"),
+    "onnx_threads": int(os.getenv("EMBEDDING_ONNX_THREADS", 0)) or None,
+}
+
+def initialise_embeddings(backend:Literal['torch', 'onnx']):
+    if backend == "onnx":
+        from core.onnx_embeddings import OnnxEmbeddings
+        return OnnxEmbeddings(
+            EMBEDDING_BACKEND['onnx_directory'],
+            file_name=EMBEDDING_BACKEND['onnx_file'],
+            batch_size=encode_kwargs['batch_size'],
+            threads=EMBEDDING_BACKEND['onnx_threads']
+        )
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+    embedding_function = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs=encode_kwargs
+    )
+    embedding_function.show_progress = True
+    return embedding_function
+
+@_LAZY.register("BASE_EMBEDDING_FUNCTION")
+def _create_base_embedding_function():
+    return initialise_embeddings(EMBEDDING_BACKEND['backend'])
+
+@_LAZY.register("EMBEDDING_FUNCTION")
+def _create_embedding_function():
+    import redis as sync_redis
+    from core.embedding_batcher import EmbeddingMicroBatcher
+    from core.embedding_cache import CachedEmbeddings
+    base_embedding_function = _LAZY.get("BASE_EMBEDDING_FUNCTION")
+    return CachedEmbeddings(
+        base_embedding_function,
+        max_size=EMBEDDING_CACHE['max_size'],
+        # embed_query runs in executor threads, so the shared cache uses a sync client
+        redis_client=sync_redis.Redis(host="localhost", port=6379) if EMBEDDING_CACHE['redis_backed'] else None,
+        redis_ttl=EMBEDDING_CACHE['redis_ttl'],
+        # Quantized vectors differ slightly, so they are never served for the torch backend
+        namespace=f"embedding_cache:{model_name}" + (":onnx" if EMBEDDING_BACKEND['backend'] == "onnx" else ""),
+        batcher=EmbeddingMicroBatcher(
+            base_embedding_function,
+            run_blocking=RUN_BLOCKING,
+            max_batch_size=EMBEDDING_BATCH['max_batch_size'],
+            max_wait_ms=EMBEDDING_BATCH['max_wait_ms']
+        ) if EMBEDDING_BATCH['enabled'] else None
+    )
 
 
 
 # ** VECTOR DB RELATED INITIALS **
-def VECTOR_STORE(directory_name:str) -> Callable[[str], Chroma]:
-    vectorstore:Chroma = Chroma(
-        persist_directory=directory_name, 
-        embedding_function=EMBEDDING_FUNCTION,
-        collection_metadata={"hnsw:space": "cosine"}
+# One immutable handle per (tenant, division), so requests for different shops never share a collection
+VECTOR_DIRECTORIES: Dict[Literal['document', 'website', 'database'], str] = {
+    'document': 'chroma_db_directory/document_vector_db',
+    'website': 'chroma_db_directory/website_vector_db',
+    'database': 'chroma_db_directory/database_vector_db',
+}
+
+@_LAZY.register("VECTOR_REGISTRY")
+def _create_vector_registry():
+    from core.vector_registry import VectorStoreRegistry
+    return VectorStoreRegistry(
+        directories=VECTOR_DIRECTORIES,
+        embedding_function=_LAZY.get("EMBEDDING_FUNCTION"),
+        max_open=int(os.getenv("VECTOR_REGISTRY_MAX_OPEN", 64)),
+        idle_seconds=float(os.getenv("VECTOR_REGISTRY_IDLE_SECONDS", 1800)),
+        # Caps the HNSW indexes chromadb keeps loaded, 0 keeps every opened one
+        memory_limit_bytes=int(os.getenv("VECTOR_REGISTRY_MEMORY_LIMIT_MB", 2048)) * 1024 * 1024
     )
-    
-    def set_collection(collection_name:str)->Chroma:
-        vectorstore._chroma_collection = vectorstore._client.get_or_create_collection(
-            name=collection_name,
-            metadata={"hnsw:space": "cosine"}
-        )
-        return vectorstore
-    
-    return set_collection
+
+def _vector_store(tenant:str, division:str, create:bool = False) -> "Chroma":
+    return _LAZY.get("VECTOR_REGISTRY").get(tenant, division, create=create)
+
+def HAS_TENANT(tenant:str) -> bool:
+    """Whether `tenant` was ingested, blocking, run it through RUN_BLOCKING from async code."""
+    return _LAZY.get("VECTOR_REGISTRY").has_tenant(tenant)
 
 VECTOR_DB: Dict[
     Literal['document', 'website', 'database'], 
-    Callable[[str], Chroma]
+    Callable[..., "Chroma"]  # (tenant, create=False)
 ] = {
-    'document': VECTOR_STORE('chroma_db_directory/document_vector_db'),
-    'website': VECTOR_STORE('chroma_db_directory/website_vector_db'),
-    'database': VECTOR_STORE('chroma_db_directory/database_vector_db'),
+    division: partial(_vector_store, division=division)
+    for division in VECTOR_DIRECTORIES
 }
 
+# Collection version, bumped after every ingestion run to invalidate derived caches
+async def GET_COLLECTION_VERSION(collection_name:str) -> int:
+    version = await _LAZY.get("REDIS_CLIENT").get(f"collection_version:{collection_name}")
+    return int(version or 0)
+
+async def BUMP_COLLECTION_VERSION(collection_name:str) -> int:
+    return await _LAZY.get("REDIS_CLIENT").incr(f"collection_version:{collection_name}")
+
 
 
 
@@ -120,7 +300,8 @@ def GET_CONFIGS(key:str):
     except json.JSONDecodeError:
         raise ValueError("Invalid JSON format in config file!")
 
-COLLECTION_NAME = 'vishal'
+# Default tenant, used when a request does not name its shop
+COLLECTION_NAME = os.getenv("DEFAULT_TENANT", 'vishal')
 
 DIVISIONS: Dict[
     Literal['db', 'doc', 'web'],
@@ -143,39 +324,125 @@ FILTERING_MINIMUM_SCORE : dict[
     "website" : 30
 }
 
-# Define the prompt template
-PRE_PROMPTS:Dict[
-    Literal['followUp', 'memory', 'system', 'division'], str
+# Session memory, turns are summarized in batches and large summaries are stored zlib compressed
+MEMORY: Dict[
+    Literal['compress', 'compress_min_size', 'summary_token_threshold', 'idle_seconds'], Any
 ] = {
-    'followUp':"""
-        You are an AI system designed to determine whether a new user query is a **strict follow-up** to a previous query.
-
-        ### **Definition of a Strict Follow-up Query**
-        A query is a follow-up **ONLY IF** it meets **ALL** of these conditions:
-        1. **It explicitly references something mentioned in the previous query** (e.g., "those", "it", "that product", "from before").
-        2. **It cannot be answered meaningfully without first knowing the previous query.**
-        3. **It directly builds on details, choices, or context provided in the previous query.**
-        4. **If asked alone, the new query would be unclear, incomplete, or ambiguous.**
-        5. **It must have an implicit or explicit dependency on the previous query.** (e.g., refining, clarifying, or extending it).
-
-        ### **Strict Rejection Criteria**
-        A query is **NOT** a follow-up if:
-        - It introduces a **new topic or request** that was not explicitly stated in the previous query.
-        - It **can be understood and answered independently** without needing the previous query.
-        - It refers to **a specific entity (e.g., "Stain and Glaze") that is not explicitly mentioned** in the previous query.
-        - It is **loosely related in topic but does not depend on** the previous query.
-        - It asks for general product information but then specifies a particular category in the next question.
+    "compress": os.getenv("MEMORY_COMPRESS", "true").lower() == "true",
+    "compress_min_size": int(os.getenv("MEMORY_COMPRESS_MIN_SIZE", 1024)),  # characters
+    "summary_token_threshold": int(os.getenv("MEMORY_SUMMARY_TOKEN_THRESHOLD", 600)),  # raw turns summarized past this
+    "idle_seconds": int(os.getenv("MEMORY_IDLE_SECONDS", 300))  # buffered turns summarized after this much silence
+}
 
-        ---
-        **Previous Query:** "{prev_query}"  
-        **New Query:** "{current_query}"  
-        ---
+# Optional per session vector memory, the prompt recalls the most relevant past turns instead of a summary
+EPISODIC_MEMORY: Dict[
+    Literal['enabled', 'top_k', 'max_turns'], Any
+] = {
+    "enabled": os.getenv("EPISODIC_MEMORY_ENABLED", "false").lower() == "true",
+    "top_k": int(os.getenv("EPISODIC_MEMORY_TOP_K", 4)),
+    "max_turns": int(os.getenv("EPISODIC_MEMORY_MAX_TURNS", 200))
+}
 
-        ### **Instructions**
-        - **ONLY respond with "yes" or "no".**  
-        - **Do NOT assume** a follow-up if there is any ambiguity. If unsure, default to **"no"**.  
-        - **If the new query can be fully understood and answered alone, respond with "no"**, even if it shares a similar topic.  
-    """,
+# FAQ questions answered directly, scores below FILTERING_MINIMUM_SCORE['document'] are never considered
+FAQ_INDEX: Dict[
+    Literal['enabled', 'direct_score', 'embedding_check', 'embedding_threshold'], Any
+] = {
+    "enabled": os.getenv("FAQ_INDEX_ENABLED", "true").lower() == "true",
+    "direct_score": float(os.getenv("FAQ_DIRECT_SCORE", 90)),  # lower of rapidfuzz token set and token sort ratio
+    "embedding_check": os.getenv("FAQ_EMBEDDING_CHECK", "true").lower() == "true",
+    "embedding_threshold": float(os.getenv("FAQ_EMBEDDING_THRESHOLD", 0.8))  # cosine similarity
+}
+
+# Semantic answer cache, answers are reused when the query embedding is close enough
+SEMANTIC_CACHE: Dict[
+    Literal['enabled', 'threshold', 'ttl', 'max_entries'], Any
+] = {
+    "enabled": os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true",
+    "threshold": float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92)),  # cosine similarity
+    "ttl": int(os.getenv("SEMANTIC_CACHE_TTL", 3600)),  # seconds
+    "max_entries": int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 500))  # per collection and division
+}
+
+# Identical concurrent questions share one pipeline run, optionally across workers through redis
+SINGLE_FLIGHT: Dict[
+    Literal['enabled', 'distributed', 'lock_ttl_ms', 'backlog_ttl', 'wait_timeout'], Any
+] = {
+    "enabled": os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true",
+    "distributed": os.getenv("SINGLE_FLIGHT_DISTRIBUTED", "false").lower() == "true",
+    "lock_ttl_ms": int(os.getenv("SINGLE_FLIGHT_LOCK_TTL_MS", 60000)),
+    "backlog_ttl": int(os.getenv("SINGLE_FLIGHT_BACKLOG_TTL", 30)),  # seconds the published tokens stay readable
+    "wait_timeout": float(os.getenv("SINGLE_FLIGHT_WAIT_TIMEOUT", 10))  # seconds without a token before answering locally
+}
+
+# Per request stage timings, the latest ones are served by the admin debug endpoint
+TIMING: Dict[
+    Literal['history_size', 'admin_token'], Any
+] = {
+    "history_size": int(os.getenv("TIMING_HISTORY_SIZE", 200)),
+    "admin_token": os.getenv("ADMIN_DEBUG_TOKEN")  # endpoint is disabled when unset
+}
+
+# Logged in customers come from a token signed by the shop backend, never from the request body
+CUSTOMER_AUTH: Dict[Literal['secret'], Any] = {
+    "secret": os.getenv("CUSTOMER_TOKEN_SECRET", ""),  # personal queries are refused when unset
+}
+
+# Local division classifier, the llm is only asked when the centroid margin is ambiguous
+DIVISION_CLASSIFIER: Dict[
+    Literal['enabled', 'min_margin', 'directory'], Any
+] = {
+    "enabled": os.getenv("DIVISION_CLASSIFIER_ENABLED", "true").lower() == "true",
+    "min_margin": float(os.getenv("DIVISION_CLASSIFIER_MIN_MARGIN", 0.05)),
+    "directory": "chroma_db_directory/division_centroids"
+}
+
+# BM25 keyword index fused with the vector results, rebuilt after every ingestion
+KEYWORD_INDEX: Dict[
+    Literal['enabled', 'directory', 'top_n', 'rrf_k', 'rare_df', 'reduced_fetch_k'], Any
+] = {
+    "enabled": os.getenv("KEYWORD_INDEX_ENABLED", "true").lower() == "true",
+    "directory": "chroma_db_directory/keyword_index",
+    "top_n": int(os.getenv("KEYWORD_INDEX_TOP_N", 20)),
+    "rrf_k": int(os.getenv("KEYWORD_INDEX_RRF_K", 60)),
+    "rare_df": int(os.getenv("KEYWORD_INDEX_RARE_DF", 5)),  # a token in at most this many chunks is an exact lookup
+    "reduced_fetch_k": int(os.getenv("KEYWORD_INDEX_REDUCED_FETCH_K", 40))
+}
+
+# Context sent to the llm, duplicates are removed and the rest is cut at a token budget per division
+CONTEXT_PACKER: Dict[
+    Literal['enabled', 'budgets', 'default_budget', 'near_duplicate_threshold', 'shingle_size', 'overlap_window', 'min_overlap'], Any
+] = {
+    "enabled": os.getenv("CONTEXT_PACKER_ENABLED", "true").lower() == "true",
+    "budgets": {
+        "database": int(os.getenv("CONTEXT_BUDGET_DATABASE", 2500)),
+        "document": int(os.getenv("CONTEXT_BUDGET_DOCUMENT", 1500)),
+        "website": int(os.getenv("CONTEXT_BUDGET_WEBSITE", 1500))
+    },
+    "default_budget": int(os.getenv("CONTEXT_BUDGET_DEFAULT", 1500)),
+    "near_duplicate_threshold": float(os.getenv("CONTEXT_NEAR_DUPLICATE_THRESHOLD", 0.8)),  # shingle jaccard
+    "shingle_size": 5,  # words
+    "overlap_window": 200,  # characters, splitters overlap chunks by 100
+    "min_overlap": 30  # characters
+}
+
+# Optional cross-encoder re-rank of the final candidates, vector order is kept when over budget or busy.
+# The model is loaded at startup when enabled
+CROSS_ENCODER: Dict[
+    Literal['enabled', 'model', 'top_k', 'time_budget_ms', 'batch_size', 'max_length', 'max_in_flight'], Any
+] = {
+    "enabled": os.getenv("CROSS_ENCODER_ENABLED", "false").lower() == "true",
+    "model": os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2"),
+    "top_k": int(os.getenv("CROSS_ENCODER_TOP_K", 5)),
+    "time_budget_ms": int(os.getenv("CROSS_ENCODER_TIME_BUDGET_MS", 300)),
+    "batch_size": int(os.getenv("CROSS_ENCODER_BATCH_SIZE", 32)),
+    "max_length": int(os.getenv("CROSS_ENCODER_MAX_LENGTH", 256)),
+    "max_in_flight": int(os.getenv("CROSS_ENCODER_MAX_IN_FLIGHT", 1))  # scoring runs on the executor at once
+}
+
+# Define the prompt template
+PRE_PROMPTS:Dict[
+    Literal['memory', 'system', 'routing', 'followUp'], str
+] = {
     'memory': """
         Summarize the following conversation in **no more than 300 words** while keeping key details and maintaining clarity. 
 
@@ -228,94 +495,72 @@ PRE_PROMPTS:Dict[
         **Previous (if any):** {last_question}  
         **History:** {history}  
     """,
-    'division': """
-        You are an AI assistant that classifies user queries into one of three categories based on intent, context, and emotion.  
-        Additionally, you should understand the user’s emotions—whether they are **curious, frustrated, confused, or making a general inquiry**—to improve classification accuracy.  
+    'routing': """
+        You are an AI router for a shopping assistant. For the **New Query** decide three things at once:
+        whether it is a strict follow-up, which knowledge division answers it, and which filter tag applies.
+
+        ### **1. is_follow_up**
+        `true` **ONLY IF** the new query explicitly references the previous query (e.g., "those", "it", "that product", "from before"),
+        cannot be answered meaningfully without it and would be unclear or incomplete if asked alone.
+        It is `false` if it introduces a new topic, names a specific entity not mentioned before, or can be answered independently.
+        If there is no previous query or you are unsure, answer `false`.
+
+        ### **2. division**
+        - `"database"` → personal orders, carts, past purchases, order tracking, products, prices, stock, categories,
+          discounts, sales, counts/totals, recommendations, blogs/posts, authors or publishing dates.
+          (e.g., *"Where is my order?"*, *"Show me laptops under $1000"*, *"Is there any sale on shoes?"*)
+        - `"document"` → policies, guidelines, FAQs, rules, customer support, ordering/payment/refund/return/exchange process,
+          legal or security questions, or explaining an incomplete phrase.
+          (e.g., *"Can I order by phone?"*, *"What is your refund policy?"*, *"How is my data protected?"*)
+        - `"website"` → company details, services, about us, contact, links, reviews, testimonials or general knowledge.
+          (e.g., *"What services does your company provide?"*, *"Tell me about Nikola Tesla."*)
+        Frustration or urgency about an order → `"database"`; confusion about a policy → `"document"`.
+
+        ### **3. filter_tag**
+        One of `"product_tag"`, `"product_category_tag"`, `"order_tag"`, `"cart_tag"`, `"post_tag"`, `"post_category_tag"`
+        when the query is clearly about that entity (categories/types/kinds of products or posts use the `*_category_tag`),
+        otherwise `null`.
 
         ---
-
-        ### **1. 'document'** → Select this category if the user is looking for **guidance, policies, FAQs, or official instructions**.  
-        **Common scenarios:**  
-        a. Policies, guidelines, instructions, rules, limitations, or regulations.  
-        b. Complaints, **customer support**, service-related doubts, or **feature clarifications**.  
-        c. **FAQs** or commonly asked questions about how something works.  
-        d. If a user provides an **incomplete phrase** and asks for an explanation.  
-        e. **Ordering process:** How to place an order, available **payment methods, refund policies, return/exchange processes**.  
-        f. **Legal or security-related queries** (e.g., "How is my data protected?" or "What are the terms of use?").  
-
-        **Examples:**  
-        - *"Can I order by phone?"* → **document** ✅ (This is about the ordering process, not a specific order.)  
-        - *"How do I return a product?"* → **document** ✅ (Policy-related question.)  
-        - *"What is your refund policy?"* → **document** ✅ (Asking for rules and policies.)  
-        - *"What does 'out of stock' mean?"* → **document** ✅ (User is confused about a phrase.)  
-
+        **Previous Query:** "{prev_query}"  
+        **New Query:** "{current_query}"  
         ---
 
-        ### **2. 'database'** → Select this category if the user is asking for **data related to orders, products, carts, categories, or user-specific information**.  
-        **Common scenarios:**  
-        a. Information about **their personal orders, carts, products, or past purchases**.  
-        b. **Details about items**: lists, prices, varieties, availability, or specifications of orders, carts, products, categories, or services.  
-        c. **Counting requests**: total number of orders, items in cart, product categories, available discounts, or stock.  
-        d. **Sales and promotions**: user wants to know about discounts or ongoing offers.  
-        e. **Product/service tracking**: checking an order status, shipment tracking, or estimated delivery time.  
-        f. **Blog/Post-related queries**: asking for articles, blog posts, publishing date, author names, or links. 
-        g. **Category-based recommendations** (e.g., suggesting products, categories, or blog posts). 
-
-        **Examples:**  
-        - *"Where is my order?"* → **database** ✅ (Asking for personal order tracking.)  
-        - *"How many items are in my cart?"* → **database** ✅ (Asking for specific user data.)  
-        - *"Show me all available laptops under $1000."* → **database** ✅ (Requesting product details.)  
-        - *"What is the price of iPhone 15 Pro?"* → **database** ✅ (Asking for product pricing.)  
-        - *"Is there any sale on shoes?"* → **database** ✅ (User wants to know about discounts.)  
-        - *"I love watches, do you have watches?"* → **database** ✅ (Checking product availability.)  
-        - *"Who is the author of the blog/post 'The Importance of Time Management'?"* → **website** ✅ (Asking about blog details.)  
-        - *"My wife’s anniversary is coming, suggest me a ring for a gift."* → **database** ✅ (Seeking product recommendation.)  
-
-        ---
+        ### **Instructions**
+        - Respond with **only** one JSON object, no explanation and no code fences:
+          {{"is_follow_up": true|false, "division": "database"|"document"|"website", "filter_tag": "<tag>"|null}}
+    """,
+    'followUp': """
+        You are an AI router for a shopping assistant. For the **New Query** decide whether it is a strict follow-up
+        of the previous query and which filter tag applies.
 
-        ### **3. 'website'** → Select this category if the user is asking for **general website-related or publicly available information**.  
-        **Common scenarios:**  
-        a. **Company details**: services, about us, links, mission statement, or contact information.  
-        b. **Website policies & guidelines** (specific to the website, not general policies).  
-        c. **Customer reviews, testimonials, or external feedback.**  
-        d. **General knowledge, factual inquiries, or people-related questions.**  
-        e. **Incomplete or unclear phrases** where the user is asking for clarification.  
+        ### **1. is_follow_up**
+        `true` **ONLY IF** the new query explicitly references the previous query (e.g., "those", "it", "that product", "from before"),
+        cannot be answered meaningfully without it and would be unclear or incomplete if asked alone.
+        It is `false` if it introduces a new topic, names a specific entity not mentioned before, or can be answered independently.
+        If you are unsure, answer `false`.
 
-        **Examples:**  
-        - *"What services does your company provide?"* → **website** ✅ (Company-related question.)  
-        - *"Can you share customer reviews?"* → **website** ✅ (User wants to see feedback/testimonials.)  
-        - *"Tell me about Nikola Tesla."* → **website** ✅ (General knowledge question.)  
-        - *"Explain the phrase 'time is money'."* → **website** ✅ (User wants phrase explanation.)  
+        ### **2. filter_tag**
+        One of `"product_tag"`, `"product_category_tag"`, `"order_tag"`, `"cart_tag"`, `"post_tag"`, `"post_category_tag"`
+        when the query is clearly about that entity, otherwise `null`.
 
         ---
-
-        ### **Emotion & Context Awareness**  
-        If the user query contains frustration (e.g., *"Why is my order late?"*), confusion (e.g., *"I don't understand the return policy."*), or urgency (e.g., *"Where is my order? It's delayed!"*), prioritize a more precise classification:  
-        - **Frustration + Order Tracking → 'database'
-        - **Frustration + Order Tracking → 'database'** (Example: *"Why is my order late?"*)  
-        - **Confusion/Curiosity + Policies → 'document'** (Example: *"I don't understand the return policy."*)  
-        - **Urgency + Order Issue → 'database'** (Example: *"Where is my order? It's delayed!"*)  
-        - **Curiosity + Blog/Posts Details → 'database'** (Example: *"Who wrote the article on time management?"*)  
-
+        **Previous Query:** "{prev_query}"  
+        **New Query:** "{current_query}"  
         ---
 
-        ### **📌 Final Classification Prompt**
-        **Use the following classification system to categorize user queries:**
-
-        #### **User Query:**  
-        ```{user_query}```  
-
-        **Respond with only one category name:**  
-        - `'database'` → If the query is about personal orders, blogs, posts, product details, stock, pricing, carts, suggestions, totals, or discounts.  
-        - `'document'` → If the query is about policies, FAQs, order/refund/return/exchange process, or general guidance.  
-        - `'website'` → If the query is about the company, services, links, customer feedback, general knowledge, or website-related topics.  .  
-
+        ### **Instructions**
+        - Respond with **only** one JSON object, no explanation and no code fences:
+          {{"is_follow_up": true|false, "filter_tag": "<tag>"|null}}
     """
 }
 
 # Falback message
 FALLBACK_MESSAGE = 'Sorry, i am unable to find any valid results. Please, try with another question 😊'
 
+# Personal questions (orders, purchases, cart) asked without a logged in customer
+LOGIN_MESSAGE = 'Please log in to your account so I can look up your orders and purchases 🔒'
+
 
 
 # ** PATTERN RELATED INITIALS **
@@ -376,6 +621,16 @@ FILTER_TAG_PATTERNS: Dict[
     )
 }
 
+# Valid chroma metadata tags, also accepted from the routing LLM call
+FILTER_TAGS: List[str] = [
+    'product_category_tag',
+    'post_category_tag',
+    'product_tag',
+    'order_tag',
+    'post_tag',
+    'cart_tag'
+]
+
 CHROMA_FILTER_PATTERNS: Dict[
     Literal[
         'order_pattern', 
@@ -389,6 +644,14 @@ CHROMA_FILTER_PATTERNS: Dict[
     "product_category_pattern" : r'\b(categor(?:y|ies)|products?(?:types?|categor(?:y|ies))|categor(?:y|ies)details?)\b'
 }
 
+# Column names holding customer and order ids, stored as typed chroma metadata
+ID_METADATA_PATTERNS: Dict[
+    Literal['customer_id', 'order_id'], Any
+] = {
+    "customer_id": re.compile(r'(?:consumers?|customers?|users?|buyers?)_?id$', re.IGNORECASE),
+    "order_id": re.compile(r'orders?_?id$', re.IGNORECASE)
+}
+
 # Pre compiled follow pattern
 FOLLOW_UP_PATTERN:List = list(re.compile(pattern, re.IGNORECASE) for pattern in  [
     r"\b(next|anymore|continues?|another|else|extend|next|go (?:aheads?|on)?)\b",  # Single-word implicit follow-ups
@@ -401,3 +664,11 @@ FOLLOW_UP_PATTERN:List = list(re.compile(pattern, re.IGNORECASE) for pattern in
 ])
 
 
+
+# Single pass scanner over every greeting, user and filter tag pattern
+INTENT_SCANNER = IntentScanner(
+    GREETING_PATTERNS
+    | {"nice_to_meet_you": r'nice to meet you', "how_are_you": r'how are you'}
+    | USER_PATTERN
+    | FILTER_TAG_PATTERNS
+)
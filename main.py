@@ -1,17 +1,143 @@
-from fastapi import FastAPI
+import hmac
+import json
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from fastapi import FastAPI, Header, HTTPException
+from core.cross_encoder import CrossEncoderReranker
+from core.customer_auth import InvalidCustomerToken, verify_customer_token
+from core.faq_index import FaqIndex
 from core.rag import Rag
 from core.models import ChatInput
+from core.timing import ServerTimingStreamingResponse, TimingLog
+import initial
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Resources are created on first use unless asked for upfront
+    if initial.WARM_UP_RESOURCES:
+        await initial.WARM_UP(*(() if initial.WARM_UP_RESOURCES == ['all'] else initial.WARM_UP_RESOURCES))
+    # The FAQ fast path needs its index before the first request, config.json is the default shop's
+    await initial.RUN_BLOCKING(FaqIndex.build, initial.COLLECTION_NAME)
+    # Loading the cross-encoder inside a request would blow its time budget
+    await initial.RUN_BLOCKING(CrossEncoderReranker.warm_up)
+    yield
+    # Let pending memory writes finish before the worker exits
+    await initial.BACKGROUND_TASKS.drain(initial.BACKGROUND_TASKS_DRAIN_TIMEOUT)
 
 # Initialize FastAPI
-app = FastAPI()
-from fastapi.responses import StreamingResponse
+app = FastAPI(lifespan=lifespan)
+
+STREAM_MEDIA_TYPES = {
+    "text": "text/plain",
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson",
+}
+
+def authenticate_customer(input: ChatInput, authorization: Optional[str]) -> Optional[int]:
+    """Customer id from the `Authorization: Bearer` token, anonymous when there is none."""
+
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Invalid customer token")
+    # A customer of one shop is never looked up in another shop's data
+    try:
+        customer = verify_customer_token(token.strip(), input.tenant or initial.COLLECTION_NAME)
+    except InvalidCustomerToken as e:
+        raise HTTPException(status_code=401, detail=f"Invalid customer token: {e}")
+    return customer.customer_id
+
+
 @app.post("/chat/")
-async def chat(input: ChatInput):
-    """Handles user queries and maintains conversation history."""
+async def chat(
+    input: ChatInput,
+    format: Literal['text', 'sse', 'ndjson'] = 'text',
+    authorization: Optional[str] = Header(default=None)
+):
+    """Handles user queries and streams the answer as the llm generates it."""
+
+    customer_id = authenticate_customer(input, authorization)
+    # Only shops that were ingested exist, a request never creates collections
+    if not await initial.RUN_BLOCKING(initial.HAS_TENANT, input.tenant or initial.COLLECTION_NAME):
+        raise HTTPException(status_code=404, detail="Unknown shop")
+    rag_instance = Rag(input, customer_id=customer_id)
+    stream = rag_instance.astream()
+
+    # Run up to the first token, so the headers carry the timings of the prepare phase
+    first_chunk = await anext(stream, None)
+
+    def encode(chunk: str) -> str:
+        if format == 'sse':
+            return f"data: {json.dumps({'token': chunk})}\n\n"
+        elif format == 'ndjson':
+            return json.dumps({'token': chunk}) + "\n"
+        return chunk
 
-    rag_instance = Rag(input)
-    response = await rag_instance.invoke()
     async def streamable_response():
-        async for chunk in response.astream({}):
-            yield chunk
-    return StreamingResponse(streamable_response(), media_type="text/plain")
+        if first_chunk is not None:
+            yield encode(first_chunk)
+        async for chunk in stream:
+            yield encode(chunk)
+
+        # Structured formats end with the measured latencies
+        timings = {
+            'ttft_ms': round((rag_instance.time_to_first_token or 0) * 1000, 1),
+            'total_ms': round((rag_instance.total_time or 0) * 1000, 1),
+            'stages_ms': rag_instance.timer.as_dict(),
+        }
+        if rag_instance.context_stats:
+            timings |= {
+                'context_tokens': rag_instance.context_stats.tokens_out,
+                'tokens_saved': rag_instance.context_stats.tokens_saved,
+            }
+        if format == 'sse':
+            yield f"event: done\ndata: {json.dumps(timings)}\n\n"
+        elif format == 'ndjson':
+            yield json.dumps({'done': True} | timings) + "\n"
+
+    return ServerTimingStreamingResponse(
+        streamable_response(),
+        media_type=STREAM_MEDIA_TYPES[format],
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Server-Timing": rag_instance.timer.server_timing(),
+        },
+        server_timing=rag_instance.timer.server_timing
+    )
+
+
+def check_admin_token(x_admin_token: Optional[str]):
+    """Debug endpoints only exist when `ADMIN_DEBUG_TOKEN` is set, and need it in `X-Admin-Token`."""
+
+    admin_token = initial.TIMING['admin_token']
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/debug/timings/")
+async def debug_timings(limit: int = 50, x_admin_token: Optional[str] = Header(default=None)):
+    """Latest per-request stage breakdowns, newest first."""
+
+    check_admin_token(x_admin_token)
+    return {"timings": TimingLog.recent(max(1, min(limit, initial.TIMING['history_size'])))}
+
+
+@app.get("/debug/metrics/")
+async def debug_metrics(x_admin_token: Optional[str] = Header(default=None)):
+    """Background queue depth, its counters, the open vector store handles, the query embedding cache and batches."""
+
+    check_admin_token(x_admin_token)
+    return {
+        "background_tasks": initial.BACKGROUND_TASKS.stats(),
+        "vector_stores": initial.VECTOR_REGISTRY.stats() if initial.IS_INITIALISED("VECTOR_REGISTRY") else None,
+        "embedding_cache": initial.EMBEDDING_FUNCTION.stats() if initial.IS_INITIALISED("EMBEDDING_FUNCTION") else None,
+        "embedding_batches": (
+            initial.EMBEDDING_FUNCTION.batcher.stats()
+            if initial.IS_INITIALISED("EMBEDDING_FUNCTION") and initial.EMBEDDING_FUNCTION.batcher is not None
+            else None
+        ),
+    }
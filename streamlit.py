@@ -3,6 +3,7 @@ import requests
 import uuid
 import time
 import html
+import os
 
 API_URL = "http://127.0.0.1:8000/chat"
 
@@ -54,13 +55,20 @@ if user_input:
 
     payload = {
         "message": user_input,
-        "session_id": st.session_state["session_id"]
+        "session_id": st.session_state["session_id"],
     }
 
+    # Demo customer, signed the way the shop backend would when the secret is available locally
+    headers = {}
+    if os.getenv("CUSTOMER_TOKEN_SECRET"):
+        import initial
+        from core.customer_auth import create_customer_token
+        headers["Authorization"] = f"Bearer {create_customer_token(26, initial.COLLECTION_NAME)}"
+
     start_time = time.time()
 
     try:
-        with requests.post(API_URL, json=payload, stream=True) as response:
+        with requests.post(API_URL, json=payload, headers=headers, stream=True) as response:
             response.raise_for_status()
 
             full_response = ""